@@ -0,0 +1,5 @@
+"""Helpers shared by the atlas-forge scripts of several species.
+
+The scripts aren't installed as a package, so they put the root of this
+repository on ``sys.path`` before importing from here.
+"""
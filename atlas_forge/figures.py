@@ -0,0 +1,49 @@
+"""Cache figures of volumes, so that unchanged volumes aren't plotted again.
+
+brainglobe-template-builder's plots save each figure twice, as a png and a
+pdf (see ``_save_and_close_figure``). A cached figure is both of those files,
+stored under a key derived from the plotted volume and the plot parameters.
+"""
+
+import hashlib
+import json
+import shutil
+
+import numpy as np
+
+figure_suffixes = (".png", ".pdf")
+
+
+def volume_hash(volume):
+    """Hash a volume's contents, shape and dtype."""
+    digest = hashlib.blake2b(
+        f"{volume.shape}{volume.dtype}".encode(), digest_size=16
+    )
+    digest.update(np.ascontiguousarray(volume).data)
+    return digest.hexdigest()
+
+
+def figure_key(volume, *params):
+    """Cache key of a figure of a volume, plotted with json-able params."""
+    return hashlib.blake2b(
+        json.dumps([volume_hash(volume), *params], sort_keys=True).encode(),
+        digest_size=16,
+    ).hexdigest()
+
+
+def cached_figure(key, cache_dir, plots_dir, filename, plot):
+    """Save the figure with this key as ``plots_dir/filename`` .png and .pdf.
+
+    If the cache doesn't hold both files of the figure, ``plot(cache_dir,
+    key)`` is called first; it must save them as ``cache_dir/key`` .png and
+    .pdf, e.g. with ``_save_and_close_figure``. Returns whether the figure
+    was already cached.
+    """
+    cached = [cache_dir / f"{key}{suffix}" for suffix in figure_suffixes]
+    hit = all(path.exists() for path in cached)
+    if not hit:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        plot(cache_dir, key)
+    for path, suffix in zip(cached, figure_suffixes):
+        shutil.copyfile(path, plots_dir / f"{filename}{suffix}")
+    return hit
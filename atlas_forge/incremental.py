@@ -0,0 +1,726 @@
+"""Only re-run the subjects whose inputs changed since the last run.
+
+brainglobe-template-builder's standardise and preprocess take a csv with
+one row per subject and process every row. To only run the rows that
+changed, each changed row is run on its own, in a worker process, and its
+outputs are merged into the output directory. A manifest records the
+signature of each row's inputs, so the next run can tell what changed, and
+every output the row owns, so they can be deleted when it changes.
+"""
+
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pandas as pd
+import tifffile
+
+from .masking import kernels_in_voxels, separable_masking
+from .profiling import profile_preprocess, summarise_profile
+
+
+def hash_file(path):
+    """sha256 of a file's contents."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_signature(path, previous):
+    """mtime, size and hash of an input file.
+
+    The hash is only recomputed if the mtime or size changed.
+    """
+    stat = Path(path).stat()
+    if (
+        previous
+        and previous["path"] == str(path)
+        and previous["mtime"] == stat.st_mtime
+        and previous["size"] == stat.st_size
+    ):
+        return previous
+    return {
+        "path": str(path),
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+        "sha256": hash_file(path),
+    }
+
+
+def content_key(signature):
+    """A signature with each file signature replaced by its hash."""
+    if isinstance(signature, dict):
+        if "sha256" in signature:
+            return signature["sha256"]
+        return {key: content_key(value) for key, value in signature.items()}
+    return signature
+
+
+def same_inputs(signature, previous):
+    """Whether two signatures describe the same inputs.
+
+    A touched but unchanged file doesn't count as a change.
+    """
+    return content_key(signature) == content_key(previous)
+
+
+def estimated_memory(row, output_vox_size):
+    """Rough peak memory (in bytes) of standardising a row.
+
+    Only used for a subject's first run, before its peak memory has been
+    measured (see expected_memory). Each stack is assumed to be held in its
+    own dtype plus two float64 copies while it's reoriented and resampled,
+    and its resampled copy (as float64) is kept until the QC plots are
+    written. Tif headers give the shape and dtype without reading any
+    pixels; for other formats, the on-disk size is taken as the size in
+    memory of 16-bit data.
+    """
+    resolution = [row[f"resolution_{i}"] for i in range(3)]
+    if output_vox_size is None:
+        scale = 1
+    else:
+        scale = math.prod(r / output_vox_size for r in resolution)
+    total = 0
+    for column in ["filepath", "mask_filepath"]:
+        if column not in row or pd.isna(row[column]):
+            continue
+        path = Path(row[column])
+        if path.suffix in (".tif", ".tiff"):
+            with tifffile.TiffFile(path) as tif:
+                series = tif.series[0]
+                n_voxels = math.prod(series.shape)
+                itemsize = series.dtype.itemsize
+        else:
+            itemsize = 2
+            n_voxels = path.stat().st_size // itemsize
+        total += n_voxels * (itemsize + 2 * 8)
+        total += math.ceil(n_voxels * scale) * 8
+    return total
+
+
+def input_size(signature):
+    """Total size (in bytes) of the files in a signature."""
+    if not isinstance(signature, dict):
+        return 0
+    if "sha256" in signature:
+        return signature["size"]
+    return sum(input_size(value) for value in signature.values())
+
+
+def expected_memory(previous, signature, measured, estimate):
+    """Memory (in bytes) a subject is expected to need.
+
+    That's the peak RSS measured the last time the subject ran, if its
+    input files have the same size. Otherwise, it's the largest peak RSS per
+    input byte measured for any subject ([(peak RSS, input size)] in
+    measured), times the subject's input size. Before anything has been
+    measured, it's estimate.
+    """
+    size = input_size(signature)
+    if "peak_rss" in previous and input_size(previous["signature"]) == size:
+        return previous["peak_rss"]
+    ratios = [peak / inputs for peak, inputs in measured if inputs > 0]
+    if ratios:
+        return math.ceil(max(ratios) * size)
+    return estimate
+
+
+
+def rows_in_use(df):
+    """The rows of df whose use column is true (all rows without one).
+
+    use has to be true/false, yes/no or 1/0, in any case. Anything else,
+    including an empty cell, raises a ValueError instead of counting as
+    true. The rows that are kept have use set to True, so standardise and
+    preprocess, which filter on it too, keep them.
+    """
+    if "use" not in df.columns:
+        return df
+    values = {
+        **dict.fromkeys(["true", "yes", "1", "1.0"], True),
+        **dict.fromkeys(["false", "no", "0", "0.0"], False),
+    }
+    use = df["use"].map(lambda value: values.get(str(value).strip().lower()))
+    invalid = use.isna()
+    if invalid.any():
+        raise ValueError(
+            "use has to be True or False, not "
+            + ", ".join(
+                f"{value!r} ({subject})"
+                for subject, value in zip(
+                    df["subject_id"][invalid], df["use"][invalid]
+                )
+            )
+        )
+    df = df[use.astype(bool)].copy()
+    df["use"] = True
+    return df
+
+
+def row_signature(row, previous, output_vox_size):
+    """Everything a row's standardised outputs depend on.
+
+    That is its csv values (paths, origin, resolution...), the contents of
+    its image and mask, and the output voxel size. previous is the row's
+    signature from the last run, whose file hashes are reused if the files
+    weren't touched.
+    """
+    files = {
+        column: file_signature(
+            row[column], previous.get("files", {}).get(column)
+        )
+        for column in ["filepath", "mask_filepath"]
+        if column in row and pd.notna(row[column])
+    }
+    return {
+        "row": json.loads(row.to_json()),
+        "output_vox_size": output_vox_size,
+        "files": files,
+    }
+
+
+# ITK (and OpenMP) start a thread per core by default, in each worker
+thread_variables = ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", "OMP_NUM_THREADS"]
+
+
+@contextmanager
+def threads_per_process(n_threads):
+    """Limit ITK and OpenMP to n_threads in processes started in this block.
+
+    Worker processes are spawned with a copy of the environment, so the
+    limit is set before they import ITK.
+    """
+    previous = {name: os.environ.get(name) for name in thread_variables}
+    os.environ.update({name: str(n_threads) for name in thread_variables})
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def run_and_measure(function, *args):
+    """Run function(*args), and return the peak RSS of the process in bytes.
+
+    Each task runs in a fresh worker process (see run_in_parallel), so that
+    is the peak of the task.
+    """
+    function(*args)
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 2**10
+
+
+def run_in_parallel(tasks, workers=1, memory_budget_gb=None):
+    """Run tasks in worker processes, within a memory budget.
+
+    tasks is a list of (subject, expected memory in bytes, function, args).
+    They are started in order, as long as fewer than workers are running
+    and the expected memory of the running ones plus the next one fits in
+    the budget (no budget if None). A task that doesn't fit on its own is
+    run alone. Each task gets a fresh process, with the available cores
+    split between the workers. Returns the peak RSS of each subject.
+    """
+    budget = math.inf if memory_budget_gb is None else memory_budget_gb * 2**30
+    n_threads = max(1, len(os.sched_getaffinity(0)) // workers)
+    queued = list(tasks)
+    running, peaks = {}, {}
+    with threads_per_process(n_threads), ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        max_tasks_per_child=1,
+    ) as executor:
+        while queued or running:
+            while (
+                queued
+                and len(running) < workers
+                and (
+                    not running
+                    or sum(estimate for _, estimate in running.values())
+                    + queued[0][1]
+                    <= budget
+                )
+            ):
+                subject, estimate, function, args = queued.pop(0)
+                if estimate > budget:
+                    print(
+                        f"{subject} needs an estimated "
+                        f"{estimate / 2**30:.1f} GB, more than the budget, "
+                        "running it alone"
+                    )
+                future = executor.submit(run_and_measure, function, *args)
+                running[future] = subject, estimate
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                subject, estimate = running.pop(future)
+                # re-raises errors from the worker
+                peaks[subject] = future.result()
+                print(
+                    f"{subject} peaked at {peaks[subject] / 2**30:.1f} GB "
+                    f"(expected {estimate / 2**30:.1f} GB)"
+                )
+    return peaks
+
+
+# outputs that may hold paths into the temporary directory of a run
+text_suffixes = {".csv", ".json", ".jsonl", ".log", ".txt", ".yaml", ".yml"}
+# outputs that list one entry per line, e.g. preprocess' list of all
+# preprocessed images, or a stage profile
+list_suffixes = {".jsonl", ".txt"}
+
+
+def remove_output(output_dir, output):
+    """Delete an output, and the directories it leaves empty."""
+    path = output_dir / output
+    path.unlink(missing_ok=True)
+    for directory in path.parents:
+        if directory == output_dir or any(directory.iterdir()):
+            break
+        directory.rmdir()
+
+
+def merge_table(table_path, rows):
+    """Replace the rows of the subjects in rows, in a csv of all subjects."""
+    if table_path.exists():
+        table = pd.read_csv(table_path, dtype={"subject_id": str})
+        rows = pd.concat(
+            [table[~table["subject_id"].isin(rows["subject_id"])], rows]
+        )
+    rows.to_csv(table_path, index=False)
+
+
+def merge_run_outputs(run_output_dir, output_dir, subject, owners, tables):
+    """Move the outputs of one subject's run into output_dir.
+
+    Paths into run_output_dir are rewritten to point into output_dir, in
+    every text output. Csvs with a subject_id column (e.g.
+    standardised_images.csv) are tables of all subjects: the subject's rows
+    are merged into them (see merge_table), and they are added to tables.
+    Lists (.txt and .jsonl) are shared too: their lines are returned, for
+    incremental_run to write them for all subjects. Every run writes its own
+    log, so logs get the subject added to their name. Any other file belongs
+    to the subject, and is recorded in owners ({output: subject}); a file
+    that another subject already owns raises a FileExistsError, instead of
+    being overwritten. Returns the outputs that belong to the subject, and
+    its lines of each list.
+    """
+    outputs, lines = [], {}
+    for path in sorted(run_output_dir.rglob("*")):
+        if path.is_dir():
+            continue
+        relative_path = path.relative_to(run_output_dir)
+        if path.suffix in text_suffixes:
+            text = path.read_text()
+            path.write_text(text.replace(str(run_output_dir), str(output_dir)))
+        if path.suffix == ".csv":
+            rows = pd.read_csv(path, dtype={"subject_id": str})
+            if "subject_id" in rows.columns:
+                (output_dir / relative_path).parent.mkdir(
+                    parents=True, exist_ok=True
+                )
+                merge_table(output_dir / relative_path, rows)
+                if str(relative_path) not in tables:
+                    tables.append(str(relative_path))
+                continue
+        if path.suffix in list_suffixes:
+            lines[str(relative_path)] = path.read_text().splitlines()
+            continue
+        if path.suffix == ".log":
+            relative_path = relative_path.with_name(
+                f"{path.stem}_{subject}{path.suffix}"
+            )
+        owner = owners.get(str(relative_path))
+        if owner is not None and owner != subject:
+            raise FileExistsError(
+                f"{subject} and {owner} both write {relative_path}, but only "
+                "csvs with a subject_id column can be merged"
+            )
+        (output_dir / relative_path).parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(path, output_dir / relative_path)
+        owners[str(relative_path)] = subject
+        outputs.append(str(relative_path))
+    return {"outputs": outputs, "lines": lines}
+
+
+def incremental_run(
+    rows,
+    output_dir,
+    manifest_path,
+    signature,
+    run_subject,
+    csv_name,
+    full=False,
+    workers=1,
+    memory_budget_gb=None,
+    estimate=None,
+):
+    """Run run_subject on the rows whose inputs changed since the last run.
+
+    rows has one row per subject_id. signature(row, previous) returns
+    everything a row's outputs depend on, given the row's signature from the
+    last run. Each new or changed row is written to a one-row csv (named
+    csv_name) and run_subject(subject_csv, run_dir, signature) writes its
+    outputs into run_dir/"output", in a worker process (see run_in_parallel
+    and expected_memory, which estimate(row) is the fallback of). The
+    outputs are then merged into output_dir (see merge_run_outputs), and
+    tables and lists are written in the order of rows. The manifest records
+    each subject's signature, its peak RSS, its lines of each list and every
+    output it owns, so the outputs of changed and removed rows can be
+    deleted first. With full=True, every row is run again.
+    """
+    manifest = {"subjects": {}, "tables": [], "lists": []}
+    if manifest_path.exists():
+        manifest.update(json.loads(manifest_path.read_text()))
+    assert rows["subject_id"].is_unique, "Needs one row per subject_id"
+    signatures, changed = {}, []
+    for _, row in rows.iterrows():
+        subject = row["subject_id"]
+        previous = manifest["subjects"].get(subject, {})
+        signatures[subject] = signature(row, previous.get("signature", {}))
+        outputs_exist = all(
+            (output_dir / output).exists()
+            for output in previous.get("outputs", [])
+        )
+        if (
+            full
+            or not previous
+            or not same_inputs(signatures[subject], previous["signature"])
+            or not outputs_exist
+        ):
+            changed.append(subject)
+    removed = set(manifest["subjects"]) - set(signatures)
+    print(
+        f"Running {len(changed)} new or changed subjects, keeping "
+        f"{len(signatures) - len(changed)}, removing {len(removed)}"
+    )
+
+    # garbage-collect the outputs of removed subjects, and the stale outputs
+    # of changed ones
+    stale = removed | set(changed)
+    for subject in stale:
+        for output in manifest["subjects"].get(subject, {}).get("outputs", []):
+            remove_output(output_dir, output)
+    tables = [
+        table for table in manifest["tables"] if (output_dir / table).exists()
+    ]
+    for table in tables:
+        table_rows = pd.read_csv(output_dir / table, dtype={"subject_id": str})
+        table_rows = table_rows[~table_rows["subject_id"].isin(stale)]
+        table_rows.to_csv(output_dir / table, index=False)
+    entries = {
+        subject: manifest["subjects"][subject]
+        for subject in signatures
+        if subject not in changed
+    }
+    owners = {
+        output: subject
+        for subject, entry in entries.items()
+        for output in entry["outputs"]
+    }
+    measured = [
+        (entry["peak_rss"], input_size(entry["signature"]))
+        for entry in manifest["subjects"].values()
+        if "peak_rss" in entry
+    ]
+
+    if changed:
+        with TemporaryDirectory() as tmp_dir:
+            tasks = []
+            for subject in changed:
+                run_dir = Path(tmp_dir) / subject
+                subject_csv = run_dir / "changed" / csv_name
+                subject_csv.parent.mkdir(parents=True)
+                row = rows[rows["subject_id"] == subject]
+                row.to_csv(subject_csv, index=False)
+                memory = expected_memory(
+                    manifest["subjects"].get(subject, {}),
+                    signatures[subject],
+                    measured,
+                    0 if estimate is None else estimate(row.iloc[0]),
+                )
+                tasks.append(
+                    (
+                        subject,
+                        memory,
+                        run_subject,
+                        (subject_csv, run_dir, signatures[subject]),
+                    )
+                )
+            peaks = run_in_parallel(tasks, workers, memory_budget_gb)
+            for subject in changed:
+                entries[subject] = {
+                    **merge_run_outputs(
+                        Path(tmp_dir) / subject / "output",
+                        output_dir,
+                        subject,
+                        owners,
+                        tables,
+                    ),
+                    "peak_rss": peaks[subject],
+                }
+
+    # keep the tables and lists in the order of rows
+    order = {subject: i for i, subject in enumerate(rows["subject_id"])}
+    for table in tables:
+        table_rows = pd.read_csv(output_dir / table, dtype={"subject_id": str})
+        table_rows = table_rows[table_rows["subject_id"].isin(order)]
+        table_rows = table_rows.sort_values(
+            "subject_id", key=lambda ids: ids.map(order)
+        )
+        table_rows.to_csv(output_dir / table, index=False)
+    lists = set(manifest["lists"]).union(
+        *[entries[subject].get("lines", {}) for subject in signatures]
+    )
+    for output in lists:
+        lines = [
+            line
+            for subject in signatures
+            for line in entries[subject].get("lines", {}).get(output, [])
+        ]
+        (output_dir / output).parent.mkdir(parents=True, exist_ok=True)
+        text = "".join(f"{line}\n" for line in lines)
+        (output_dir / output).write_text(text)
+    manifest = {
+        "subjects": {
+            subject: {**entries[subject], "signature": signatures[subject]}
+            for subject in signatures
+        },
+        "tables": sorted(tables),
+        "lists": sorted(lists),
+    }
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+
+
+def standardise_subject(subject_csv, run_dir, signature):
+    """Standardise a one-row csv into run_dir/"output".
+
+    Runs in a worker process.
+    """
+    from brainglobe_template_builder.standardise import standardise
+
+    standardise(
+        source_csv=subject_csv,
+        output_dir=run_dir / "output",
+        output_vox_size=signature["output_vox_size"],
+    )
+
+
+def incremental_standardise(
+    source_csv,
+    output_dir,
+    output_vox_size,
+    signature=row_signature,
+    run_subject=standardise_subject,
+    full=False,
+    workers=1,
+    memory_budget_gb=24,
+):
+    """Only standardise the rows of source_csv whose inputs changed.
+
+    The outputs of rows that were removed, or whose use is False (see
+    rows_in_use), are deleted. Each changed row is standardised on its own
+    (by run_subject, see standardise_subject), with up to workers at a time,
+    as long as their expected memory (see expected_memory) fits in
+    memory_budget_gb. Their rows replace the old ones in
+    standardised_images.csv, which is kept in the order of source_csv.
+    signature(row, previous, output_vox_size) is what a row's outputs depend
+    on (see row_signature), and is passed on to run_subject. The manifest is
+    standardised/standardise_manifest.json; see incremental_run.
+    """
+    rows = rows_in_use(pd.read_csv(source_csv, dtype={"subject_id": str}))
+    incremental_run(
+        rows,
+        output_dir,
+        output_dir / "standardised" / "standardise_manifest.json",
+        signature=partial(signature, output_vox_size=output_vox_size),
+        run_subject=run_subject,
+        csv_name=Path(source_csv).name,
+        full=full,
+        workers=workers,
+        memory_budget_gb=memory_budget_gb,
+        estimate=partial(estimated_memory, output_vox_size=output_vox_size),
+    )
+
+
+def read_mask_overrides(mask_overrides_csv):
+    """Per-subject MaskConfig overrides, from a csv.
+
+    The csv has a subject_id column and one column per MaskConfig field.
+    Empty cells keep the default of that field. A missing csv has no
+    overrides. Returns {subject_id: {field: value}}.
+    """
+    if not Path(mask_overrides_csv).exists():
+        return {}
+    overrides = pd.read_csv(
+        mask_overrides_csv, dtype={"subject_id": str}
+    ).set_index("subject_id")
+    return {
+        # pandas reads integer columns with empty cells as floats, but e.g.
+        # closing_size has to be an int
+        subject: {
+            field: (
+                int(value)
+                if isinstance(value, float) and value.is_integer()
+                else value
+            )
+            for field, value in row.dropna().items()
+        }
+        for subject, row in overrides.iterrows()
+    }
+
+
+def check_mask_overrides(mask_overrides, subjects):
+    """Check mask overrides before any subject is preprocessed.
+
+    Raises a ValueError for overrides of subjects that aren't in subjects,
+    or of fields MaskConfig doesn't have: MaskConfig ignores fields it
+    doesn't know, so a typo in a column name would otherwise silently keep
+    the default. Invalid values raise too, when each subject's MaskConfig
+    is built.
+    """
+    from brainglobe_template_builder.utils.preproc_config import MaskConfig
+
+    unknown_subjects = sorted(set(mask_overrides) - set(subjects))
+    if unknown_subjects:
+        raise ValueError(
+            "Mask overrides for subjects that aren't in the standardised "
+            f"csv: {unknown_subjects}"
+        )
+    unknown_fields = sorted(
+        {field for overrides in mask_overrides.values() for field in overrides}
+        - set(MaskConfig.model_fields)
+    )
+    if unknown_fields:
+        raise ValueError(
+            "Mask overrides of fields MaskConfig doesn't have: "
+            f"{unknown_fields}"
+        )
+    for overrides in mask_overrides.values():
+        MaskConfig(**overrides)
+
+
+def mask_parameters(row, mask_overrides, kernels_um):
+    """The MaskConfig fields of a row's subject.
+
+    Kernel sizes given in microns (kernels_um) are converted to voxels of
+    the row's image (see kernels_in_voxels), and the subject's own
+    mask_overrides, in voxels, are applied on top.
+    """
+    return {
+        **kernels_in_voxels(row, kernels_um),
+        **mask_overrides.get(row["subject_id"], {}),
+    }
+
+
+def preprocess_signature(
+    row, previous, mask_overrides, kernels_um, pad_pixels
+):
+    """Everything a subject's preprocessed outputs depend on.
+
+    That is its standardised row, the contents of its standardised image,
+    its mask parameters (see mask_parameters) and pad_pixels.
+    """
+    return {
+        "row": json.loads(row.to_json()),
+        "image": file_signature(row["filepath"], previous.get("image")),
+        "mask": mask_parameters(row, mask_overrides, kernels_um),
+        "pad_pixels": pad_pixels,
+    }
+
+
+def preprocess_subject(subject_csv, run_dir, signature, profile_name):
+    """Preprocess a one-row csv into run_dir/"output".
+
+    Runs in a worker process, with the subject's own mask parameters. The
+    mask is closed and eroded one axis at a time (see separable_masking).
+    The stage profile is written into the outputs as profile_name, where
+    it's merged with the profiles of the other subjects.
+    """
+    from brainglobe_template_builder.utils.preproc_config import (
+        MaskConfig,
+        PreprocConfig,
+    )
+
+    output_dir = run_dir / "output"
+    config = PreprocConfig(
+        output_dir=output_dir,
+        mask=MaskConfig(**signature["mask"]),
+        pad_pixels=signature["pad_pixels"],
+    )
+    profile_path = output_dir / profile_name
+    profile_path.parent.mkdir(parents=True)
+    with separable_masking():
+        profile_preprocess(subject_csv, config, profile_path=profile_path)
+
+
+def incremental_preprocess(
+    standardised_csv,
+    output_dir,
+    mask_overrides=None,
+    kernels_um=None,
+    pad_pixels=5,
+    full=False,
+    workers=1,
+    memory_budget_gb=None,
+):
+    """Only preprocess the subjects whose inputs changed.
+
+    Each subject's MaskConfig is built from kernels_um, converted for the
+    resolution of its image, and its mask_overrides ({subject_id: {field:
+    value}}, see read_mask_overrides), on top of the MaskConfig defaults;
+    see mask_parameters. They're checked before any subject runs (see
+    check_mask_overrides). Subjects that are new or whose signature changed
+    (e.g. because their mask parameters changed) are preprocessed again, up
+    to workers at a time, each on its own, and their outputs are merged
+    into output_dir: the lists of all preprocessed images and masks, and
+    the stage profile, are rebuilt from every subject's lines. Outputs of
+    subjects that are no longer in standardised_csv are deleted. The stage
+    profile (preprocess_profile.jsonl, summarised by summarise_profile) and
+    the manifest (preprocess_manifest.json, see incremental_run) are
+    written next to standardised_csv, like the standardise manifest. With
+    full=True, every subject is preprocessed again.
+    """
+    standardised_csv = Path(standardised_csv)
+    mask_overrides = mask_overrides or {}
+    rows = rows_in_use(
+        pd.read_csv(standardised_csv, dtype={"subject_id": str})
+    )
+    check_mask_overrides(mask_overrides, rows["subject_id"])
+    profile_path = standardised_csv.with_name("preprocess_profile.jsonl")
+    incremental_run(
+        rows,
+        output_dir,
+        standardised_csv.with_name("preprocess_manifest.json"),
+        signature=partial(
+            preprocess_signature,
+            mask_overrides=mask_overrides,
+            kernels_um=kernels_um or {},
+            pad_pixels=pad_pixels,
+        ),
+        # the profile's lines are merged into output_dir, so it's named
+        # relative to it
+        run_subject=partial(
+            preprocess_subject,
+            profile_name=profile_path.relative_to(output_dir),
+        ),
+        csv_name=standardised_csv.name,
+        full=full,
+        workers=workers,
+        memory_budget_gb=memory_budget_gb,
+    )
+    if profile_path.exists():
+        summarise_profile(profile_path)
@@ -0,0 +1,119 @@
+"""Mask parameters in microns, and a faster mask for large kernels.
+
+brainglobe-template-builder's MaskConfig takes its kernel sizes in voxels,
+so they have to be scaled by hand whenever the resolution changes. Here they
+can be given in microns instead, and are converted for each image from its
+resolution_0..2 columns.
+
+Its create_mask closes and erodes the mask by a cube of voxels, which costs
+the cube of the kernel size per voxel. A cube is the sum of three lines, one
+along each axis, so closing and eroding by each line in turn gives the same
+mask, at a cost that only grows linearly with the kernel size. The gaussian
+smoothing before thresholding is separable already.
+"""
+
+import importlib
+from contextlib import contextmanager
+
+import numpy as np
+from scipy import ndimage
+
+# the MaskConfig fields that are kernel sizes, in voxels
+kernel_fields = ["gaussian_sigma", "closing_size", "erode_size"]
+
+
+def kernels_in_voxels(row, kernels_um):
+    """Convert MaskConfig kernel sizes from microns to voxels of a row's image.
+
+    kernels_um maps some of kernel_fields to sizes in microns. The sigma
+    can be fractional; footprint sizes are rounded to whole voxels, but a
+    non-zero size stays at least 1. Raises a ValueError for other fields,
+    or if the image doesn't have isotropic voxels (standardised images do).
+    """
+    unknown_fields = sorted(set(kernels_um) - set(kernel_fields))
+    if unknown_fields:
+        raise ValueError(f"Not kernel sizes of MaskConfig: {unknown_fields}")
+    resolutions = {float(row[f"resolution_{i}"]) for i in range(3)}
+    if len(resolutions) != 1:
+        raise ValueError(
+            f"{row['subject_id']}: kernel sizes in microns need isotropic "
+            f"voxels, got {sorted(resolutions)} um"
+        )
+    resolution = resolutions.pop()
+    voxels = {}
+    for field, size_um in kernels_um.items():
+        if field == "gaussian_sigma":
+            voxels[field] = size_um / resolution
+        elif size_um:
+            voxels[field] = max(1, round(size_um / resolution))
+        else:
+            voxels[field] = 0
+    return voxels
+
+
+def line_footprints(ndim, size):
+    """Lines of size voxels along each axis, which sum to a cube."""
+    for axis in range(ndim):
+        shape = [1] * ndim
+        shape[axis] = size
+        yield np.ones(shape, dtype=bool)
+
+
+def erode_by_cube(mask, size):
+    """Binary erosion by a cube of size voxels, one axis at a time.
+
+    Voxels beyond the border count as inside the mask, as in
+    skimage.morphology.binary_erosion, which gives the same result.
+    """
+    for footprint in line_footprints(mask.ndim, size):
+        mask = ndimage.binary_erosion(mask, footprint, border_value=True)
+    return mask
+
+
+def close_by_cube(mask, size):
+    """Binary closing by a cube of size voxels, one axis at a time.
+
+    Gives the same result as skimage.morphology.binary_closing.
+    """
+    for footprint in line_footprints(mask.ndim, size):
+        mask = ndimage.binary_dilation(mask, footprint)
+    return erode_by_cube(mask, size)
+
+
+def create_mask(
+    image,
+    gauss_sigma=3,
+    threshold_method="triangle",
+    closing_size=5,
+    erode_size=0,
+):
+    """brainglobe-template-builder's create_mask, closing and eroding by lines.
+
+    The smoothing, thresholding and choice of the largest object are left
+    to create_mask; its closing and erosion by cubes are done here instead,
+    by close_by_cube and erode_by_cube.
+    """
+    from brainglobe_template_builder.utils.masking import (
+        create_mask as create_unclosed_mask,
+    )
+
+    mask = create_unclosed_mask(
+        image, gauss_sigma, threshold_method, closing_size=0, erode_size=0
+    )
+    if closing_size > 0:
+        mask = close_by_cube(mask, closing_size)
+    if erode_size > 0:
+        mask = erode_by_cube(mask, erode_size)
+    return mask
+
+
+@contextmanager
+def separable_masking():
+    """Make preprocess use create_mask from this module, within this block."""
+    module = importlib.import_module("brainglobe_template_builder.preprocess")
+    original = module.create_mask
+    module.create_mask = create_mask
+    try:
+        yield
+    finally:
+        module.create_mask = original
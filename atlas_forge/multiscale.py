@@ -0,0 +1,116 @@
+"""Build resolution pyramids and save them as OME-Zarr multiscale images."""
+
+import numpy as np
+from skimage import transform
+
+
+def downsample_lazily(stack, factors):
+    """Lazily downsample a dask stack by factors (output / input size).
+
+    The stack is read one plane (along axis 0) at a time, with all its other
+    axes whole, and rescaled within the plane first, then along axis 0,
+    with bilinear interpolation and anti-aliasing (like
+    brainglobe-template-builder's downsampling). Axes that aren't rescaled,
+    e.g. channels, are rescaled along axis 0 one index at a time. Returns a
+    float64 dask array, so nothing is read until it's computed.
+    """
+    if any(factor > 1 for factor in factors):
+        raise ValueError(f"Factors {factors} would upsample the stack")
+    kwargs = {
+        "order": 1,
+        "anti_aliasing": True,
+        "preserve_range": True,
+        "dtype": np.float64,
+    }
+    # rescale rounds the size of each axis
+    shape = [round(n * factor) for n, factor in zip(stack.shape, factors)]
+    stack = stack.rechunk(
+        {0: 1, **{axis: -1 for axis in range(1, stack.ndim)}}
+    )
+    in_plane = stack.map_blocks(
+        transform.rescale,
+        (1, *factors[1:]),
+        chunks=((1,) * stack.shape[0], *[(n,) for n in shape[1:]]),
+        **kwargs,
+    )
+    unscaled = [axis for axis in range(1, stack.ndim) if factors[axis] == 1]
+    in_plane = in_plane.rechunk({0: -1, **{axis: 1 for axis in unscaled}})
+    return in_plane.map_blocks(
+        transform.rescale,
+        (factors[0], *[1] * (stack.ndim - 1)),
+        chunks=tuple(
+            (1,) * n if axis in unscaled else (n,)
+            for axis, n in enumerate(shape)
+        ),
+        **kwargs,
+    )
+
+
+def pyramid_resolutions(shape, resolution_um, min_size=64):
+    """Resolutions of a pyramid, halving until an axis would be < min_size.
+
+    The first level is the stack itself, at resolution_um.
+    """
+    resolutions = [resolution_um]
+    while min(shape) // 2 ** len(resolutions) >= min_size:
+        resolutions.append(resolution_um * 2 ** len(resolutions))
+    return resolutions
+
+
+def build_pyramid(stack, resolutions_um):
+    """Derive each coarser resolution level from the previous one.
+
+    This way the full-resolution stack is only read once, however many
+    resolutions are requested. Each resolution has to be an integer multiple
+    of the previous one. Returns a {resolution_um: stack} dict.
+    """
+    levels = {resolutions_um[0]: stack}
+    for previous, resolution in zip(resolutions_um, resolutions_um[1:]):
+        factor = resolution / previous
+        assert (
+            factor == int(factor) and factor > 1
+        ), f"{resolution}um is not a coarser multiple of {previous}um"
+        levels[resolution] = transform.downscale_local_mean(
+            levels[previous], (int(factor),) * 3
+        ).astype(stack.dtype)
+    return levels
+
+
+def save_ome_zarr(levels, path, chunks=(64, 64, 64)):
+    """Save resolution levels as a chunked, blosc-compressed OME-Zarr.
+
+    ``levels`` maps each resolution (in microns) to its stack, from finest
+    to coarsest, as returned by ``build_pyramid``.
+    """
+    import zarr
+
+    # zarr 3 takes "compressors" (zarr.codecs) instead of a numcodecs
+    # "compressor", and would reject the storage options below
+    if int(zarr.__version__.split(".")[0]) != 2:
+        raise ImportError(
+            f"save_ome_zarr needs zarr 2, not {zarr.__version__} "
+            '(pip install "zarr<3")'
+        )
+    from numcodecs import Blosc
+    from ome_zarr.io import parse_url
+    from ome_zarr.writer import write_multiscale
+
+    root = zarr.group(store=parse_url(path, mode="w").store, overwrite=True)
+    write_multiscale(
+        list(levels.values()),
+        group=root,
+        axes=[
+            {"name": axis, "type": "space", "unit": "micrometer"}
+            for axis in "zyx"
+        ],
+        coordinate_transformations=[
+            [{"type": "scale", "scale": [resolution] * 3}]
+            for resolution in levels
+        ],
+        storage_options={
+            "chunks": chunks,
+            "compressor": Blosc(
+                cname="zstd", clevel=5, shuffle=Blosc.BITSHUFFLE
+            ),
+        },
+    )
@@ -0,0 +1,175 @@
+"""Profile the per-subject stages of brainglobe-template-builder's preprocess.
+
+preprocess only logs when it starts (through the standard logging module),
+so its stages can't be told apart from its log records. Instead, the
+functions it calls for each subject are wrapped while it runs, and every
+call is written as one line of JSON with the cost of that stage.
+"""
+
+import importlib
+import json
+import resource
+import time
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+import pandas as pd
+
+# The functions that preprocess calls for each subject, and the stage each
+# of them is reported as. preprocess takes standardised images, which are
+# already in ASR, so there is no reorientation stage (standardise does it).
+preprocess_stages = {
+    "load_any": "load",
+    "correct_image_brightness": "bias_correct",
+    "create_mask": "mask",
+    "crop_to_mask": "pad",
+    "plot_grid": "qc_plot",
+    "_save_niftis": "save",
+}
+
+
+def io_counters():
+    """Bytes read and written by this process so far.
+
+    Returns None where /proc/self/io doesn't exist.
+    """
+    try:
+        counters = dict(
+            line.split(": ")
+            for line in Path("/proc/self/io").read_text().splitlines()
+        )
+    except OSError:
+        return None
+    # rchar/wchar also count I/O on network filesystems (ceph), which
+    # read_bytes/write_bytes miss
+    return int(counters["rchar"]), int(counters["wchar"])
+
+
+def snapshot():
+    return {
+        "wall": time.perf_counter(),
+        "cpu": time.process_time(),
+        "io": io_counters(),
+    }
+
+
+class StageProfiler:
+    """Write the cost of each call of a wrapped function as a line of JSON.
+
+    Each line holds the subject that was being processed when the call
+    started, the stage, its wall and CPU time, the peak RSS of the process
+    so far, and the bytes read and written. Lines are flushed as they are
+    written, so the profile is complete up to the point where a SLURM job
+    was killed.
+    """
+
+    def __init__(self, profile_path):
+        self.file = open(profile_path, "w", buffering=1)
+        self.subject = None
+
+    def wrap(self, function, stage):
+        """Return function, profiled as stage."""
+
+        @wraps(function)
+        def profiled(*args, **kwargs):
+            subject, start = self.subject, snapshot()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.write(subject, stage, start)
+
+        return profiled
+
+    def write(self, subject, stage, start):
+        end = snapshot()
+        if end["io"] and start["io"]:
+            io = [e - s for e, s in zip(end["io"], start["io"])]
+        else:
+            io = [None, None]
+        line = {
+            "subject": subject,
+            "stage": stage,
+            "wall_time_s": end["wall"] - start["wall"],
+            "cpu_time_s": end["cpu"] - start["cpu"],
+            # ru_maxrss is a high-water mark, so it grows in the stage that
+            # needed the memory
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            / 1024,
+            "bytes_read": io[0],
+            "bytes_written": io[1],
+        }
+        self.file.write(json.dumps(line) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+@contextmanager
+def profiled_preprocess_stages(profiler):
+    """Profile the stages of preprocess with profiler, within this block."""
+    module = importlib.import_module("brainglobe_template_builder.preprocess")
+    originals = {
+        name: getattr(module, name)
+        for name in [*preprocess_stages, "_process_subject"]
+        if hasattr(module, name)
+    }
+    missing = set(preprocess_stages) - set(originals)
+    if missing:
+        print(f"Not profiling {sorted(missing)}: not called by preprocess")
+    process_subject = originals["_process_subject"]
+
+    @wraps(process_subject)
+    def subject_scope(subject_row, *args, **kwargs):
+        profiler.subject = str(subject_row.subject_id)
+        try:
+            return process_subject(subject_row, *args, **kwargs)
+        finally:
+            profiler.subject = None
+
+    try:
+        for name, stage in preprocess_stages.items():
+            if name in originals:
+                setattr(module, name, profiler.wrap(originals[name], stage))
+        module._process_subject = subject_scope
+        yield
+    finally:
+        for name, function in originals.items():
+            setattr(module, name, function)
+
+
+def profile_preprocess(source_csv, config, profile_path):
+    """Run preprocess with its stages profiled into profile_path (JSONL)."""
+    from brainglobe_template_builder.preprocess import preprocess
+
+    profiler = StageProfiler(profile_path)
+    try:
+        with profiled_preprocess_stages(profiler):
+            preprocess(source_csv, config=config)
+    finally:
+        profiler.close()
+
+
+def summarise_profile(profile_path):
+    """Summarise a profile per subject and per stage, next to it."""
+    profile = pd.read_json(profile_path, lines=True)
+    if profile.empty:
+        print(f"No stages recorded in {profile_path}")
+        return
+    per_subject = (
+        profile.groupby("subject")
+        .agg(
+            wall_time_s=("wall_time_s", "sum"),
+            cpu_time_s=("cpu_time_s", "sum"),
+            peak_rss_mb=("peak_rss_mb", "max"),
+            bytes_read=("bytes_read", "sum"),
+            bytes_written=("bytes_written", "sum"),
+        )
+        .sort_values("wall_time_s", ascending=False)
+    )
+    per_stage = profile.pivot_table(
+        index="subject", columns="stage", values="wall_time_s", aggfunc="sum"
+    )
+    summary = per_subject.join(per_stage.add_prefix("wall_time_s_"))
+    summary.to_csv(profile_path.with_name("preprocess_profile_subjects.csv"))
+    print(summary.to_string(float_format="%.1f"))
@@ -0,0 +1,36 @@
+#!/bin/bash
+
+#SBATCH -J slurm_crab_downsample # job name
+#SBATCH -p cpu # partition
+#SBATCH -N 1   # number of nodes
+#SBATCH --mem 32G # memory pool for all cores
+#SBATCH -n 4 # number of cores
+#SBATCH -t 0-04:00 # time (D-HH:MM)
+#SBATCH -o slurm.%x.%N.%A_%a.out # write STDOUT
+#SBATCH -e slurm.%x.%N.%A_%a.err # write STDERR
+#SBATCH --mail-type=ALL
+#SBATCH --mail-user=<name@email.com>
+
+# Load the required modules
+module load /ceph/neuroinformatics/neuroinformatics/modules/modulefiles/template-builder/2024-12-02
+
+# Run this script directly (bash configure_slurm_downsample_crab.sh) to submit it as an array job,
+# with one task per Atl* subject folder (at most 10 at a time)
+if [ -z "${SLURM_JOB_ID}" ]; then
+  n_subjects=$(python downsample_raw_crab.py --n_subjects)
+  if ! [[ "${n_subjects}" =~ ^[0-9]+$ ]]; then
+    echo "Couldn't count the subjects (got '${n_subjects}'), not submitting" >&2
+    exit 1
+  fi
+  if [ "${n_subjects}" -eq 0 ]; then
+    # an empty array would be --array=0--1, which sbatch rejects
+    echo "No Atl* subject folders to downsample, not submitting" >&2
+    exit 1
+  fi
+  exec sbatch --array=0-$((n_subjects - 1))%10 "$0"
+fi
+
+# Each array task downsamples the subject at index SLURM_ARRAY_TASK_ID
+# (subject folders are sorted by name), and skips it if its outputs already exist.
+# Keep the memory budget a bit below --mem to leave room for the python process itself.
+python downsample_raw_crab.py --memory_budget_gb 28 --target_resolutions 3 6 12
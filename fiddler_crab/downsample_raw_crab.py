@@ -1,35 +1,238 @@
 from pathlib import Path
 import nd2
-from brainglobe_template_builder.utils.transform_utils import downsample_anisotropic_stack_to_isotropic
 from brainglobe_utils.IO.image.save import save_any
-import dask.array as da
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import dask
+import numpy as np
 import os
-    
+import pandas as pd
+import shutil
+import sys
+import time
+
+# the shared helpers live in the atlas_forge package at the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from atlas_forge.multiscale import build_pyramid, downsample_lazily, save_ome_zarr  # noqa: E402
+
 input_dir = Path("/media/ceph/microscopy/collaborative_projects/crab_atlas")
 output_dir = Path("/media/ceph/zoo/raw/CrabLab/Anatomy/crab_atlas/downsampled/")
-target_resolution_um = 3
-    
-for subfolder in input_dir.iterdir():
+input_resolution_um = (3, 0.86, 0.86)
+channel_names = ["autofluorescence", "cytox", "WGA"]
+# every output is written once to output_dir and then fanned out to these extra
+# locations in the background; "hardlink" falls back to a copy across filesystems
+mirror_sinks = {Path.home()/"crab_test": "copy"}
+
+
+def available_cpus():
+    """CPUs this process may run on, e.g. those allocated by SLURM rather than all of the node's."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def list_subjects(input_dir):
+    """All Atl* subject folders, sorted so that SLURM array indices are stable across runs."""
+    subfolders = sorted(subfolder for subfolder in input_dir.iterdir() if subfolder.is_dir())
+    for subfolder in subfolders:
+        assert subfolder.name.startswith("Atl"), f"Subfolder name must start with 'Atl': {subfolder.name}"
+    return subfolders
+
+
+def output_paths(subject, target_resolutions, output_format="tif"):
+    """Where the downsampled channels of one subject are written, keyed by (channel, resolution)."""
+    if output_format == "ome-zarr":
+        # all resolution levels of a channel live in the same multiscale image
+        return {(channel_name, None): output_dir/f"{subject}/{subject}_{channel_name}.ome.zarr" for channel_name in channel_names}
+    return {
+        (channel_name, resolution): output_dir/f"{subject}/{resolution}um/{subject}_{resolution}um_{channel_name}.tif"
+        for channel_name in channel_names
+        for resolution in target_resolutions
+    }
+
+
+def written_bytes(path):
+    """Size of a written output, summed over all files for zarr directories."""
+    if path.is_dir():
+        return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+    return path.stat().st_size
+
+
+def fan_out(source_path, destination_path, mode):
+    """Hardlink or copy an already-written output (file or zarr directory), returning the number of bytes written."""
+    destination_path.parent.mkdir(parents=True, exist_ok=True)
+    if destination_path.is_dir():
+        shutil.rmtree(destination_path)
+    destination_path.unlink(missing_ok=True)
+    if mode == "hardlink":
+        try:
+            if source_path.is_dir():
+                shutil.copytree(source_path, destination_path, copy_function=os.link)
+            else:
+                os.link(source_path, destination_path)
+            return 0
+        except OSError:  # e.g. the destination is on another filesystem
+            shutil.rmtree(destination_path, ignore_errors=True)
+    if source_path.is_dir():
+        shutil.copytree(source_path, destination_path)
+    else:
+        shutil.copyfile(source_path, destination_path)
+    return written_bytes(destination_path)
+
+
+def downsample_subject(subfolder, memory_budget_mb, target_resolutions, output_format="tif", n_threads=None):
+    """Downsample all channels of one subject, keeping raw plane data within the memory budget.
+
+    At most n_threads planes are read and downsampled at once (by default, as many as there are CPUs available).
+    """
+    start = time.perf_counter()
     print(f"Started {subfolder.name}")
-    if not subfolder.is_dir():
-        continue
-    
-    assert subfolder.name.startswith("Atl"), f"Subfolder name must start with 'Atl': {subfolder.name}"
-    
     nd2_file = subfolder / f"{subfolder.name}-Stitched.nd2"
+    if not nd2_file.exists():
+        print(f"Skipping {nd2_file} because it does not exist")
+        return subfolder.name, "missing", time.perf_counter() - start, 0.0
 
-    if nd2_file.exists():
-        data = nd2.imread(str(nd2_file))
+    # nd2 memory-maps the file, so planes are only read when dask asks for them
+    with nd2.ND2File(str(nd2_file)) as nd2_data:
+        data = nd2_data.to_dask()
         print(data.shape)
-        for channel_index, channel_name in enumerate(["autofluorescence", "cytox", "WGA"]):
-            channel_data = data[:, channel_index, :, :] 
-            print(channel_data.shape)
-            channel_data = da.from_array(channel_data, chunks={0: 1, 1: channel_data.shape[1], 2: channel_data.shape[2]})
-            channel_data = downsample_anisotropic_stack_to_isotropic(channel_data,(3, 0.86, 0.86), target_resolution_um)
-            save_any(channel_data, Path.home()/"crab_test"/f"{subfolder.name}_{target_resolution_um}um_{channel_name}.tif")
-            Path.mkdir(output_dir/f"{subfolder.name}/{target_resolution_um}um/", exist_ok=True, parents=True)
-            save_any(channel_data, output_dir/f"{subfolder.name}/{target_resolution_um}um/{subfolder.name}_{target_resolution_um}um_{channel_name}.tif")
+        # the downsampled volumes (float64) have to fit in the budget alongside the planes being streamed
+        def level_nbytes(resolution):
+            return int(np.prod([data.shape[i] * input_resolution / resolution for i, input_resolution in zip((0, 2, 3), input_resolution_um)])) * 8
+
+        # all channels at the first target resolution, plus the coarser pyramid levels of the channel being saved
+        # (twice: downscale_local_mean's float64 result and its astype copy)
+        output_nbytes = len(channel_names) * level_nbytes(target_resolutions[0])
+        output_nbytes += 2 * sum(level_nbytes(resolution) for resolution in target_resolutions[1:])
+        chunk_budget = memory_budget_mb * 2**20 - output_nbytes
+        if chunk_budget <= 0:
+            print(f"The downsampled volumes alone need {output_nbytes / 2**30:.1f} GB, more than the memory budget")
+        # bound peak memory by limiting how many planes are being read/downsampled at once
+        plane_nbytes = int(np.prod(data.shape[1:])) * data.dtype.itemsize
+        planes_in_flight = max(1, int(chunk_budget // plane_nbytes))
+        # each plane is handled by one dask thread, so don't start more threads than this worker's share of the CPUs
+        planes_in_flight = min(planes_in_flight, n_threads or available_cpus())
+        print(f"Streaming {planes_in_flight} planes at a time ({plane_nbytes / 2**20:.0f} MB per plane)")
+        with dask.config.set(scheduler="threads", num_workers=planes_in_flight):
+            # every nd2 chunk holds all channels of a plane, so downsample them together (the channel axis isn't
+            # rescaled) and compute once, reading each plane once
+            z_resolution, y_resolution, x_resolution = input_resolution_um
+            target = target_resolutions[0]
+            factors = [z_resolution / target, 1, y_resolution / target, x_resolution / target]
+            volume = downsample_lazily(data, factors).compute()
+        downsampled = {channel_name: volume[:, channel_index] for channel_index, channel_name in enumerate(channel_names)}
+
+    bytes_written = dict.fromkeys([output_dir, *mirror_sinks], 0)
+    with ThreadPoolExecutor(max_workers=max(1, len(mirror_sinks))) as uploader:
+        mirrored = []
+        paths = output_paths(subfolder.name, target_resolutions, output_format)
+        for channel_name in channel_names:
+            # materialise once and write once; the mirrors copy the file rather than re-saving the array
+            levels = build_pyramid(np.asarray(downsampled.pop(channel_name)), target_resolutions)
+            if output_format == "ome-zarr":
+                to_write = {paths[(channel_name, None)]: levels}
+            else:
+                to_write = {paths[(channel_name, resolution)]: level for resolution, level in levels.items()}
+            for channel_path, channel_data in to_write.items():
+                Path.mkdir(channel_path.parent, exist_ok=True, parents=True)
+                if output_format == "ome-zarr":
+                    save_ome_zarr(channel_data, channel_path)
+                else:
+                    save_any(channel_data, channel_path)
+                bytes_written[output_dir] += written_bytes(channel_path)
+                for sink_dir, mode in mirror_sinks.items():
+                    mirrored.append((sink_dir, uploader.submit(fan_out, channel_path, sink_dir/channel_path.name, mode)))
             print(f"Saved {channel_name}")
-        print(f"Finished {subfolder.name}")
+        for sink_dir, future in mirrored:
+            bytes_written[sink_dir] += future.result()
+    for sink_dir, n_bytes in bytes_written.items():
+        print(f"Wrote {n_bytes / 2**30:.2f} GB of {subfolder.name} to {sink_dir}")
+    print(f"Finished {subfolder.name}")
+    return subfolder.name, "done", time.perf_counter() - start, sum(bytes_written.values()) / 2**30
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Downsample raw crab nd2 stacks")
+    parser.add_argument(
+        "--target_resolutions",
+        type=int,
+        nargs="+",
+        default=[3],
+        help="Isotropic resolutions (um) to downsample to, e.g. 3 6 12. The first is computed from "
+        "the raw stack, each further one from the previous one and must be a multiple of it",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of subjects to downsample in parallel",
+    )
+    parser.add_argument(
+        "--memory_budget_gb",
+        type=float,
+        default=24,
+        help="Memory available to all workers together, split evenly between subjects",
+    )
+    parser.add_argument(
+        "--subject_index",
+        type=int,
+        default=os.environ.get("SLURM_ARRAY_TASK_ID"),
+        help="Only downsample the subject at this index (defaults to the SLURM array task id, if any)",
+    )
+    parser.add_argument(
+        "--output_format",
+        choices=["tif", "ome-zarr"],
+        default="tif",
+        help="Save each channel as one tif per target resolution, "
+        "or as a multiscale OME-Zarr with one level per target resolution",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Downsample subjects even if all their outputs already exist",
+    )
+    parser.add_argument(
+        "--n_subjects",
+        action="store_true",
+        help="Only print the number of subjects (e.g. to size a SLURM array) and exit",
+    )
+    args = parser.parse_args()
+
+    subfolders = list_subjects(input_dir)
+    if args.n_subjects:
+        print(len(subfolders))
+        raise SystemExit(0)
+    if args.subject_index is not None:
+        if int(args.subject_index) >= len(subfolders):
+            # e.g. a SLURM array sized for more subjects than there are
+            print(f"No subject at index {args.subject_index}, there are only {len(subfolders)} subjects")
+            raise SystemExit(0)
+        subfolders = [subfolders[int(args.subject_index)]]
+
+    summary = []
+    to_downsample = []
+    for subfolder in subfolders:
+        if not args.overwrite and all(path.exists() for path in output_paths(subfolder.name, args.target_resolutions, args.output_format).values()):
+            print(f"Skipping {subfolder.name} because its outputs already exist")
+            summary.append((subfolder.name, "exists", 0.0, 0.0))
+        else:
+            to_downsample.append(subfolder)
+
+    memory_budget_mb = args.memory_budget_gb * 1024 / args.workers
+    # split the CPUs between the workers, so that their dask threads don't oversubscribe them
+    n_threads = max(1, available_cpus() // args.workers)
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            summary += executor.map(
+                downsample_subject,
+                to_downsample,
+                [memory_budget_mb] * len(to_downsample),
+                [args.target_resolutions] * len(to_downsample),
+                [args.output_format] * len(to_downsample),
+                [n_threads] * len(to_downsample),
+            )
     else:
-        print(f"Skipping {nd2_file} because it does not exist")
\ No newline at end of file
+        summary += [downsample_subject(subfolder, memory_budget_mb, args.target_resolutions, args.output_format, n_threads) for subfolder in to_downsample]
+
+    summary = pd.DataFrame(summary, columns=["subject", "status", "wall_time_s", "written_gb"]).sort_values("subject")
+    print(summary.to_string(index=False, float_format="%.1f"))
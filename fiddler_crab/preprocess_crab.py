@@ -1,9 +1,18 @@
-
-from brainglobe_template_builder.preprocess import preprocess
-from brainglobe_template_builder.utils.preproc_config import PreprocConfig, MaskConfig
 from pathlib import Path
+import sys
+
+# the shared helpers live in the atlas_forge package at the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from atlas_forge.incremental import incremental_preprocess  # noqa: E402
 
 if __name__ == "__main__":
     output_dir = Path("/home/alessandro/crab_atlas_forge")
-    config = PreprocConfig(output_dir=output_dir, mask=MaskConfig(gaussian_sigma=6, closing_size=10))  # double defaults for double-resolution
-    preprocess(output_dir/"standardised/standardised_images.csv", config=config)
\ No newline at end of file
+    standardised_csv = output_dir/"standardised/standardised_images.csv"
+    # mask kernels in microns, converted for each image from its resolution_0..2, so they don't need re-tuning when
+    # the resolution changes (these are gaussian_sigma=6, closing_size=10 voxels at 3 um). The closing is done one
+    # axis at a time, so large closings at 3 um cost the kernel size per voxel rather than its cube
+    kernels_um = {"gaussian_sigma": 18, "closing_size": 30}
+    # only subjects that are new, or whose standardised image or mask parameters changed, are preprocessed again;
+    # per-stage wall/CPU time, peak memory and I/O are profiled next to the standardised csv, to find what blows the
+    # SLURM time limit
+    incremental_preprocess(standardised_csv, output_dir, kernels_um=kernels_um)
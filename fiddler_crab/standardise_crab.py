@@ -1,9 +1,245 @@
-from brainglobe_template_builder.standardise import standardise
+from brainglobe_space import AnatomicalSpace
+from brainglobe_utils.IO.image import load_any
+from scipy import ndimage
+import argparse
+import itertools
+import json
+import numpy as np
+import pandas as pd
+import sys
 
 from pathlib import Path
+
+# the shared helpers live in the atlas_forge package at the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from atlas_forge.incremental import incremental_standardise, row_signature, standardise_subject  # noqa: E402
+
+# per-animal rotations from the crab metadata sheets. Which array axis of the raw stack each column rotates about,
+# with which sign and in which order, is not documented: it is recorded in rotation_convention.json by --check_rotation,
+# which finds the convention that reproduces one of the existing rotated_WGA stacks from its unrotated stack. It has to
+# be run on the cluster, where the stacks are, before any row that points at an unrotated stack can be standardised
+rotation_columns = ["x_rotation(degrees)", "y_rotation(degrees)", "rotation(degrees)"]
+rotation_convention_path = Path(__file__).parent/"rotation_convention.json"
+
+
+def rotation_matrix(axis, degrees):
+    """3x3 rotation about one array axis of a stack."""
+    theta = np.deg2rad(degrees)
+    i, j = [a for a in range(3) if a != axis]
+    matrix = np.eye(3)
+    matrix[i, i] = matrix[j, j] = np.cos(theta)
+    matrix[i, j], matrix[j, i] = -np.sin(theta), np.sin(theta)
+    return matrix
+
+
+def metadata_rotation(row, convention):
+    """Compose the rotation of a metadata row, following a convention from rotation_convention.json.
+
+    Missing (NaN) angles count as 0.
+    """
+    rotation = np.eye(3)
+    for column in convention["order"]:
+        degrees = 0 if pd.isna(row[column]) else float(row[column])
+        rotation = rotation_matrix(convention["axes"][column], convention["signs"][column] * degrees) @ rotation
+    return rotation
+
+
+def rotate_onto_grid(stack, transform, order):
+    """Resample a stack by a linear transform about its centre, onto a grid that holds the whole transformed stack.
+
+    transform maps voxel coordinates of the stack, relative to its centre, to voxel coordinates of the output, relative
+    to the output's centre.
+    """
+    centre = (np.array(stack.shape) - 1) / 2
+    corners = np.array(list(itertools.product(*[(0, n - 1) for n in stack.shape]))) - centre
+    extent = np.abs(corners @ transform.T).max(axis=0)
+    output_shape = tuple(int(np.ceil(2 * e - 1e-6)) + 1 for e in extent)
+    output_centre = (np.array(output_shape) - 1) / 2
+    # affine_transform maps output coordinates back to input coordinates
+    inverse = np.linalg.inv(transform)
+    return ndimage.affine_transform(stack, inverse, offset=centre - inverse @ output_centre, output_shape=output_shape, order=order)
+
+
+def reorientation_matrix(origin):
+    """The axis swaps and flips of AnatomicalSpace.map_stack_to from origin to ASR, as a matrix on centred coordinates."""
+    axes_order, flips, _, _ = AnatomicalSpace(origin).map_to("ASR")
+    matrix = np.zeros((3, 3))
+    for target_axis, source_axis in enumerate(axes_order):
+        matrix[target_axis, source_axis] = -1 if flips[target_axis] else 1
+    return matrix
+
+
+def rotate_and_reorient(stack, origin, rotation, resolution, output_vox_size, order):
+    """Rotate a stack about its centre, reorient it to ASR and scale it to output_vox_size, in one resampling pass.
+
+    rotation acts on the axes of the raw stack, in physical units (resolution is the raw stack's voxel size per axis).
+    """
+    transform = reorientation_matrix(origin) @ rotation @ np.diag(resolution) / output_vox_size
+    return rotate_onto_grid(stack, transform, order)
+
+
+def read_rotation_convention():
+    """The rotation convention recorded by --check_rotation."""
+    if not rotation_convention_path.exists():
+        raise FileNotFoundError(
+            f"{rotation_convention_path} not found: run standardise_crab.py --check_rotation on one subject first, to "
+            "find how the rotation columns map onto the axes of the raw stacks"
+        )
+    convention = json.loads(rotation_convention_path.read_text())
+    return {key: convention[key] for key in ["order", "axes", "signs"]}
+
+
+def needs_rotation(row):
+    """Whether standardising a row applies its metadata rotation.
+
+    Rows that point into a rotated_* folder already have their rotation baked in, so they are only reoriented.
+    """
+    if not set(rotation_columns).issubset(row.index):
+        return False
+    if any(Path(row[column]).parent.name.startswith("rotated_") for column in ["filepath", "mask_filepath"]
+           if column in row.index and pd.notna(row[column])):
+        return False
+    return any(pd.notna(row[column]) and float(row[column]) != 0 for column in rotation_columns)
+
+
+def subject_signature(row, previous, output_vox_size):
+    """row_signature, plus the rotation convention of rows that are rotated (see needs_rotation).
+
+    The convention is read here, in the main process, so that a missing one stops the run before any subject starts.
+    """
+    signature = row_signature(row, previous, output_vox_size)
+    if needs_rotation(row):
+        signature["rotation_convention"] = read_rotation_convention()
+    return signature
+
+
+def standardise_crab_subject(subject_csv, run_dir, signature):
+    """Standardise a one-row csv into run_dir/"output", like standardise_subject.
+
+    A row with a metadata rotation (see subject_signature) is not standardised by brainglobe-template-builder: its
+    image and mask are rotated, reoriented to ASR and scaled to the output voxel size by a single resampling pass each
+    (see rotate_and_reorient), and written out the way standardise writes them.
+    """
+    if "rotation_convention" not in signature:
+        return standardise_subject(subject_csv, run_dir, signature)
+    from brainglobe_template_builder.standardise import _get_subject_path, _write_QC_plots
+    from brainglobe_utils.IO.image.save import save_as_asr_nii
+
+    df = pd.read_csv(subject_csv, dtype={"subject_id": str})
+    row = df.iloc[0]
+    resolution = [row[f"resolution_{i}"] for i in range(3)]
+    output_vox_size = signature["output_vox_size"]
+    if output_vox_size is None:
+        # as in standardise, images are only left at their resolution if it's isotropic
+        if len(set(resolution)) != 1:
+            raise ValueError(f"{row['subject_id']} has anisotropic voxel size {resolution}, pass an output_vox_size")
+        output_vox_size = resolution[0]
+    rotation = metadata_rotation(row, signature["rotation_convention"])
+    standardised_dir, standardised_qc_dir = run_dir/"output"/"standardised", run_dir/"output"/"standardised-QC"
+    standardised_qc_dir.mkdir(parents=True)
+    images = {}
+    for column, order in {"filepath": 1, "mask_filepath": 0}.items():
+        if column not in row.index or pd.isna(row[column]):
+            images[column] = None
+            continue
+        angles = {c: 0 if pd.isna(row[c]) else row[c] for c in rotation_columns}
+        print(f"Rotating {Path(row[column]).name} by {angles} and reorienting {row['origin']} to ASR")
+        images[column] = rotate_and_reorient(load_any(Path(row[column])), row["origin"], rotation, resolution, output_vox_size, order)
+        output_path = _get_subject_path(standardised_dir, row["subject_id"], output_vox_size, mask=column == "mask_filepath")
+        save_as_asr_nii(images[column], vox_sizes=[output_vox_size * 0.001] * 3, dest_path=output_path)
+        df.loc[0, column] = str(output_path)
+    _write_QC_plots(standardised_qc_dir, row["subject_id"], image=images["filepath"], mask=images.get("mask_filepath"))
+    df["origin"] = "ASR"
+    for i in range(3):
+        df[f"resolution_{i}"] = output_vox_size
+    df.to_csv(standardised_dir/"standardised_images.csv", index=False)
+
+
+def rotation_conventions():
+    """Every assignment of the rotation columns to array axes, with every sign and order."""
+    for axes in itertools.permutations(range(3)):
+        for signs in itertools.product([1, -1], repeat=3):
+            for order in itertools.permutations(rotation_columns):
+                yield {"order": list(order), "axes": dict(zip(rotation_columns, axes)), "signs": dict(zip(rotation_columns, signs))}
+
+
+def centred_correlation(a, b):
+    """Pearson correlation of two stacks over the largest box, centred in both, that fits in either."""
+    shape = np.minimum(a.shape, b.shape)
+    a, b = (s[tuple(slice((n - m) // 2, (n - m) // 2 + m) for n, m in zip(s.shape, shape))] for s in (a, b))
+    return float(np.corrcoef(a.ravel().astype(np.float64), b.ravel().astype(np.float64))[0, 1])
+
+
+def check_rotation(source_csv, subject, unrotated_path, output_dir, factor=4):
+    """Find the rotation convention that reproduces a subject's rotated stack, and record it.
+
+    Rotates the subject's unrotated stack (unrotated_path) with its metadata angles under every convention (see
+    rotation_conventions), on every factor-th voxel, and compares each result with the rotated stack that its row of
+    source_csv points at. All conventions are ranked in output_dir/rotation_check_<subject>.csv, and the best one is
+    written to rotation_convention.json, for subject_signature.
+    """
+    row = pd.read_csv(source_csv, dtype={"subject_id": str}).set_index("subject_id").loc[subject]
+    unrotated = np.asarray(load_any(unrotated_path))[::factor, ::factor, ::factor].astype(np.float32)
+    reference = np.asarray(load_any(Path(row["filepath"])))[::factor, ::factor, ::factor].astype(np.float32)
+    results = []
+    for convention in rotation_conventions():
+        rotated = rotate_onto_grid(unrotated, metadata_rotation(row, convention), order=1)
+        results.append({**convention, "correlation": centred_correlation(rotated, reference)})
+    results.sort(key=lambda result: result["correlation"], reverse=True)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame(results).to_csv(output_dir/f"rotation_check_{subject}.csv", index=False)
+    best, runner_up = results[0], results[1]
+    print(f"Best convention for {subject}: {best}, runner-up correlation {runner_up['correlation']:.3f}")
+    record = {
+        **best,
+        "checked_on": {"subject": subject, "unrotated": str(unrotated_path), "rotated": str(row["filepath"]),
+                       "factor": factor, "runner_up_correlation": runner_up["correlation"]},
+    }
+    rotation_convention_path.write_text(json.dumps(record, indent=2))
+    print(f"Recorded it in {rotation_convention_path}; rows rotated with a different convention are standardised again")
+
+
 if __name__ == "__main__":
-    source_csv = Path("/home/alessandro/crab_test/3um/template-building-crab-3um-april-2026.csv")
-    output_dir = Path("/home/alessandro/crab_atlas_forge")
+    parser = argparse.ArgumentParser(description="Standardise crab images")
+    parser.add_argument(
+        "--source_csv",
+        type=Path,
+        default=Path("/home/alessandro/crab_test/3um/template-building-crab-3um-april-2026.csv"),
+        help="Csv with one image per row. If it has the x_rotation(degrees), y_rotation(degrees) and rotation(degrees) "
+        "metadata columns, these rotations are applied together with the reorientation to ASR, to rows that point at "
+        "unrotated stacks rather than into a rotated_* folder (see --check_rotation)",
+    )
+    parser.add_argument("--output_dir", type=Path, default=Path("/home/alessandro/crab_atlas_forge"))
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Standardise every row again, instead of only the rows whose inputs changed since the last run",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Number of subjects to standardise in parallel")
+    parser.add_argument(
+        "--memory_budget_gb",
+        type=float,
+        default=24,
+        help="Memory available to all workers together; subjects only start while their expected memory "
+        "(their peak on the last run, or an estimate on the first) fits in it",
+    )
+    parser.add_argument(
+        "--check_rotation",
+        type=Path,
+        help="Instead of standardising, find how the rotation columns map onto the axes of the raw stacks, by "
+        "reproducing the rotated stack that --check_subject's row of --source_csv points at (e.g. in "
+        "crab/atlas-generation-Afruca-tangeri-metadata-AF.csv) from this unrotated stack of the same subject",
+    )
+    parser.add_argument("--check_subject", default="AT2", help="Subject to check the rotation convention on")
+    args = parser.parse_args()
+
+    if args.check_rotation is not None:
+        check_rotation(args.source_csv, args.check_subject, args.check_rotation, args.output_dir)
+        raise SystemExit
+
     output_vox_size = None # already at 3 micron, no downsampling needed
-    standardise(source_csv=source_csv, output_dir=output_dir, output_vox_size=output_vox_size)
- 
\ No newline at end of file
+    # the rotations (and their convention) are part of each row's inputs, so they're only applied to the rows that are
+    # standardised again
+    incremental_standardise(args.source_csv, args.output_dir, output_vox_size, signature=subject_signature,
+                            run_subject=standardise_crab_subject, full=args.full, workers=args.workers,
+                            memory_budget_gb=args.memory_budget_gb)
@@ -0,0 +1,448 @@
+"""Benchmark the per-subject preprocessing stages on synthetic brains.
+
+Times the stages that the prep scripts run for every subject (converting the
+reoriented array to ANTs in memory, N4 bias field correction, masking, rigid
+registration with its initialisation, generating the arrays for template
+construction and writing them as NIfTI) on phantom brains at several
+resolutions, and records the peak resident memory (RSS) of each stage. The
+stages call the same helpers as the scripts (from ``prep_utils``): the arrays
+for template construction are generated lazily from arrays on the padded
+target grid, and written one at a time as they are generated.
+
+Each stage runs in a freshly spawned process, which reads its inputs from
+the outputs of the previous stages, so that its peak RSS isn't inherited
+from earlier (or larger) stages. ITK threads are not set here: export
+ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS to match the cluster jobs.
+
+Run it before a long cluster run, and compare against a previous report
+to catch regressions in the prep path, e.g.:
+
+    python benchmark_prep_stages.py --output_csv new.csv --compare old.csv
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import ants
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from brainglobe_template_builder.preproc.masking import create_mask
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from prep_utils import (  # noqa: E402
+    asr_to_ants,
+    initial_rigid_transform,
+    iter_template_arrays,
+    save_template_arrays,
+)
+
+# Stages in the order in which the prep scripts run them. Each stage reads
+# the outputs of the stages before it, so these are run (but not reported)
+# whenever a later stage is benchmarked on its own.
+stage_names = [
+    "to_ants",
+    "n4",
+    "mask",
+    "rigid",
+    "template_arrays",
+    "nifti_write",
+]
+
+# Same padding of the arrays for template construction as the prep scripts
+template_pad = 2
+
+# Same masking parameters as the blackcap prep scripts
+mask_params = {
+    "gauss_sigma": 3,
+    "threshold_method": "triangle",
+    "closing_size": 5,
+}
+
+
+def phantom_brain(
+    resolution_um: float,
+    size_mm: list[float],
+    angle_deg: float = 0,
+    shift_mm: float = 0,
+    seed: int = 0,
+) -> tuple[ants.ANTsImage, ants.ANTsImage]:
+    """Generate a synthetic brain image and its mask, in ASR orientation.
+
+    The brain is made of two ellipsoid hemispheres (split along the last
+    axis, like real brains are by ``get_right_and_left_slices``) with darker
+    ventricles and a posterior, cerebellum-like blob, so that it has a
+    well-defined rigid alignment. A smooth bias field along the A-P axis
+    and Gaussian noise are added on top. The brain can be rotated (in the
+    axial plane) and shifted (along A-P), to give a moving image that
+    rigid registration has to recover.
+    """
+    res_mm = resolution_um * 1e-3
+    # leave some background around the brain
+    shape = [int(round(1.2 * size / res_mm)) for size in size_mm]
+    a, s, r = np.ogrid[tuple(slice(0, n) for n in shape)]
+    a, s, r = (
+        ((x - (n - 1) / 2) * res_mm).astype(np.float32)
+        for x, n in zip((a, s, r), shape)
+    )
+    # python floats, so that the float32 coordinates aren't upcast
+    theta = np.deg2rad(angle_deg)
+    cos, sin = float(np.cos(theta)), float(np.sin(theta))
+    a, r = cos * a - sin * r - shift_mm, sin * a + cos * r
+
+    half_length, half_height, quarter_width = (
+        size_mm[0] / 2,
+        size_mm[1] / 2,
+        size_mm[2] / 4,
+    )
+
+    def ellipsoid(centre, radii):
+        # |r| mirrors the ellipsoid into both hemispheres
+        distance = sum(
+            ((x - c) / radius) ** 2
+            for x, c, radius in zip((a, s, np.abs(r)), centre, radii)
+        )
+        return distance <= 1
+
+    hemispheres = ellipsoid(
+        (0.1 * half_length, 0, quarter_width),
+        (0.9 * half_length, half_height, quarter_width),
+    )
+    ventricles = ellipsoid(
+        (0.2 * half_length, 0.1 * half_height, 0.6 * quarter_width),
+        (0.3 * half_length, 0.2 * half_height, 0.2 * quarter_width),
+    )
+    cerebellum = ellipsoid(
+        (-0.75 * half_length, -0.3 * half_height, 0),
+        (0.25 * half_length, 0.5 * half_height, quarter_width),
+    )
+    mask = hemispheres | cerebellum
+
+    image = np.full(shape, 50, dtype=np.float32)
+    image[hemispheres] = 1000
+    image[cerebellum & ~hemispheres] = 1400
+    image[ventricles] = 600
+    image *= 1 + 0.3 * a / half_length  # bias field
+    rng = np.random.default_rng(seed)
+    image += 20 * rng.standard_normal(shape, dtype=np.float32)
+
+    spacing = (res_mm,) * 3
+    return (
+        ants.from_numpy(image, spacing=spacing),
+        ants.from_numpy(mask.astype(np.uint8), spacing=spacing),
+    )
+
+
+def read_image(
+    work_dir: Path, name: str, pixeltype: str = "float"
+) -> ants.ANTsImage:
+    """Read an image written by an earlier stage (or by the phantom)."""
+    return ants.image_read(
+        (work_dir / f"{name}.nii").as_posix(), pixeltype=pixeltype
+    )
+
+
+def load_stage_inputs(
+    stage: str, work_dir: Path, registration_init: str | None
+) -> list:
+    """Read the inputs of a stage from the outputs of the earlier stages."""
+    if stage == "to_ants":
+        image = read_image(work_dir, "image")
+        return [image.numpy(), list(image.spacing)]
+    if stage == "n4":
+        return [read_image(work_dir, "image")]
+    image_n4 = read_image(work_dir, "image_n4")
+    if stage == "mask":
+        return [image_n4.numpy()]
+    mask = read_image(work_dir, "mask", pixeltype="unsigned char")
+    if stage == "rigid":
+        target = read_image(work_dir, "target")
+        target_mask = read_image(work_dir, "target_mask", "unsigned char")
+        outprefix = (work_dir / "rigid_").as_posix()
+        return [
+            registration_init,
+            target,
+            target_mask,
+            image_n4,
+            mask,
+            outprefix,
+        ]
+    # like the images resampled onto the padded target grid by the scripts
+    arrays_inputs = [
+        "sub-phantom",
+        np.pad(image_n4.numpy(), template_pad),
+        np.pad(mask.numpy(), template_pad),
+    ]
+    if stage == "template_arrays":
+        return arrays_inputs
+    use4template_dir = work_dir / "use4template"
+    use4template_dir.mkdir(exist_ok=True)
+    return [*arrays_inputs, use4template_dir, list(image_n4.spacing)]
+
+
+def rigid_registration(
+    registration_init: str | None,
+    target: ants.ANTsImage,
+    target_mask: ants.ANTsImage,
+    image: ants.ANTsImage,
+    mask: ants.ANTsImage,
+    outprefix: str,
+) -> dict:
+    """Rigidly register an image to the target, as the prep scripts do."""
+    return ants.registration(
+        fixed=target,
+        moving=image,
+        mask=target_mask,
+        moving_mask=mask,
+        type_of_transform="Rigid",
+        initial_transform=initial_rigid_transform(
+            registration_init, target, target_mask, image, mask, outprefix
+        ),
+        verbose=False,
+        outprefix=outprefix,
+    )
+
+
+def generate_template_arrays(
+    subject: str, image: np.ndarray, mask: np.ndarray
+) -> int:
+    """Generate all arrays for template construction, one at a time."""
+    return sum(
+        1
+        for _ in iter_template_arrays(
+            subject, image, mask, template_pad, padded=True
+        )
+    )
+
+
+def write_template_arrays(
+    subject: str,
+    image: np.ndarray,
+    mask: np.ndarray,
+    save_dir: Path,
+    vox_sizes: list[float],
+):
+    """Generate the arrays for template construction and write each one."""
+    save_template_arrays(
+        iter_template_arrays(subject, image, mask, template_pad, padded=True),
+        save_dir,
+        vox_sizes,
+    )
+
+
+stage_functions = {
+    "to_ants": asr_to_ants,
+    "n4": ants.n4_bias_field_correction,
+    "mask": lambda image: create_mask(image, **mask_params).astype(np.uint8),
+    "rigid": rigid_registration,
+    "template_arrays": generate_template_arrays,
+    "nifti_write": write_template_arrays,
+}
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in kilobytes on Linux
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def run_stage(
+    stage: str, work_dir: Path, registration_init: str | None = None
+) -> dict:
+    """Run and measure one stage. Meant to run in a fresh process."""
+    inputs = load_stage_inputs(stage, work_dir, registration_init)
+    input_rss_mb = peak_rss_mb()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    output = stage_functions[stage](*inputs)
+    wall_time_s = time.perf_counter() - wall_start
+    # process_time includes all threads, e.g. those of ITK
+    cpu_time_s = time.process_time() - cpu_start
+    rss_mb = peak_rss_mb()
+
+    # save what later stages need, after the measurement
+    if stage == "n4":
+        ants.image_write(output, (work_dir / "image_n4.nii").as_posix())
+    elif stage == "mask":
+        ants.image_write(
+            read_image(work_dir, "image_n4").new_image_like(output),
+            (work_dir / "mask.nii").as_posix(),
+        )
+    return {
+        "stage": stage,
+        "wall_time_s": wall_time_s,
+        "cpu_time_s": cpu_time_s,
+        "peak_rss_mb": rss_mb,
+        # how far the stage pushed peak memory beyond its loaded inputs
+        "stage_rss_mb": rss_mb - input_rss_mb,
+    }
+
+
+def compare_reports(
+    report: pd.DataFrame, baseline: pd.DataFrame, tolerance: float
+) -> pd.DataFrame:
+    """Compare median time and peak RSS per stage against a baseline.
+
+    Returns the (resolution, stage) pairs for which either got worse by more
+    than the tolerance (a fraction of the baseline).
+    """
+    keys = ["resolution_um", "stage"]
+    metrics = ["wall_time_s", "peak_rss_mb"]
+    medians = [df.groupby(keys)[metrics].median() for df in (report, baseline)]
+    ratios = (medians[0] / medians[1]).dropna()
+    return ratios[(ratios > 1 + tolerance).any(axis=1)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the per-subject preprocessing stages"
+    )
+    parser.add_argument(
+        "--resolutions",
+        type=float,
+        nargs="+",
+        default=[50, 25, 12],
+        help="Isotropic resolutions (um) of the phantom brains",
+    )
+    parser.add_argument(
+        "--brain_size_mm",
+        type=float,
+        nargs=3,
+        default=[8, 6, 10],
+        help="Size of the phantom brain along the A-P, S-I and R-L axes",
+    )
+    parser.add_argument(
+        "--stages",
+        choices=stage_names,
+        nargs="+",
+        default=stage_names,
+        help="Stages to report. Earlier stages whose outputs they need "
+        "are run as well, but not reported",
+    )
+    parser.add_argument(
+        "--registration_init",
+        choices=["moments", "coarse"],
+        default=None,
+        help="How to initialise the rigid registration (see "
+        "initial_rigid_transform); by default, as ants.registration does",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=1,
+        help="Number of times each stage is run; the comparison uses the "
+        "median over repeats",
+    )
+    parser.add_argument(
+        "--work_dir",
+        type=Path,
+        default=None,
+        help="Where the phantoms and stage outputs are written "
+        "(defaults to a temporary directory)",
+    )
+    parser.add_argument(
+        "--output_csv",
+        type=Path,
+        default=Path("prep_benchmark.csv"),
+        help="Where to write the report, one row per stage run",
+    )
+    parser.add_argument(
+        "--compare",
+        type=Path,
+        default=None,
+        help="A previous report to compare against. Exits with an error "
+        "if any stage got slower or uses more memory than the tolerance",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed relative increase in time and peak RSS per stage",
+    )
+    args = parser.parse_args()
+
+    last_stage = max(stage_names.index(stage) for stage in args.stages)
+    stages_to_run = stage_names[: last_stage + 1]
+    # a spawned (not forked) process starts with a small, clean RSS
+    spawn = multiprocessing.get_context("spawn")
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_root = args.work_dir or Path(tmp_dir)
+        for resolution in args.resolutions:
+            work_dir = work_root / f"res-{resolution:g}um"
+            work_dir.mkdir(parents=True, exist_ok=True)
+            target, target_mask = phantom_brain(resolution, args.brain_size_mm)
+            image, _ = phantom_brain(
+                resolution, args.brain_size_mm, angle_deg=5, shift_mm=0.2
+            )
+            for name, img in {
+                "target": target,
+                "target_mask": target_mask,
+                "image": image,
+            }.items():
+                ants.image_write(img, (work_dir / f"{name}.nii").as_posix())
+            n_voxels = int(np.prod(image.shape))
+            del target, target_mask, image
+            logger.info(
+                f"Generated {resolution:g}um phantoms with {n_voxels} voxels."
+            )
+
+            for repeat in range(args.repeats):
+                for stage in stages_to_run:
+                    with ProcessPoolExecutor(1, mp_context=spawn) as pool:
+                        row = pool.submit(
+                            run_stage, stage, work_dir, args.registration_init
+                        ).result()
+                    logger.info(
+                        f"{resolution:g}um {stage}: "
+                        f"{row['wall_time_s']:.1f} s, "
+                        f"peak RSS {row['peak_rss_mb']:.0f} MB."
+                    )
+                    if stage in args.stages:
+                        rows.append(
+                            {
+                                "resolution_um": resolution,
+                                "n_voxels": n_voxels,
+                                "repeat": repeat,
+                                **row,
+                            }
+                        )
+
+    report = pd.DataFrame(rows)
+    report["itk_threads"] = os.environ.get(
+        "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", "default"
+    )
+    report["registration_init"] = args.registration_init
+    report["created"] = datetime.now().isoformat(timespec="seconds")
+    report.to_csv(args.output_csv, index=False)
+    logger.info(f"Wrote benchmark report to {args.output_csv}.")
+    print(
+        report.groupby(["resolution_um", "stage"], sort=False)[
+            ["wall_time_s", "cpu_time_s", "peak_rss_mb", "stage_rss_mb"]
+        ]
+        .median()
+        .to_string(float_format="%.1f")
+    )
+
+    if args.compare is not None:
+        regressions = compare_reports(
+            report, pd.read_csv(args.compare), args.tolerance
+        )
+        if len(regressions) > 0:
+            logger.error(
+                f"Stages that regressed by more than {args.tolerance:.0%} "
+                f"against {args.compare} (ratios new/old):\n"
+                f"{regressions.to_string(float_format='%.2f')}"
+            )
+            sys.exit(1)
+        logger.info(f"No regressions against {args.compare}.")
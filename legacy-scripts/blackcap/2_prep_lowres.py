@@ -3,7 +3,7 @@ Prepare low-resolution BlackCap images for template construction
 ================================================================
 The following operations are performed on the lowest-resolution images to
 prepare them for template construction:
-- Import each image as tiff, re-orient to ASR and save as nifti
+- Import each image as tiff, re-orient to ASR and convert to ANTs in memory
 - Perform N4 Bias field correction using ANTs
 - Generate brain mask based on N4-corrected image
 - Rigid-register the re-oriented image to an already aligned target (with ANTs)
@@ -11,31 +11,62 @@ prepare them for template construction:
 - Split the image and mask into hemispheres and reflect each hemisphere
 - Generate symmetric brains using either the left or right hemisphere
 - Save all resulting images as nifti files to be used for template construction
+
+N4 correction, masking and registration results are cached per subject, so
+re-running the script only recomputes what changed (e.g. a new subject).
 """
 
 # %%
 # Imports
 # -------
+import multiprocessing
 import os
-from datetime import date
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from functools import cache
 from pathlib import Path
 
-import ants
-import numpy as np
-import pandas as pd
-from brainglobe_space import AnatomicalSpace
-from brainglobe_utils.IO.image.save import save_as_asr_nii
-from loguru import logger
-from tqdm import tqdm
+# Subjects are processed in parallel by n_workers processes, each limited to
+# itk_threads_per_worker threads for ITK (N4, registration), so that together
+# they use the cores allocated to this job (e.g. by SLURM) rather than
+# oversubscribing them. This has to be set before ants is imported, and is
+# inherited by the worker processes.
+available_cpus = len(os.sched_getaffinity(0))
+itk_threads_per_worker = min(4, available_cpus)
+n_workers = max(1, available_cpus // itk_threads_per_worker)
+os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(
+    itk_threads_per_worker
+)
+
+import ants  # noqa: E402
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+from brainglobe_space import AnatomicalSpace  # noqa: E402
+from brainglobe_utils.IO.image.save import save_as_asr_nii  # noqa: E402
+from loguru import logger  # noqa: E402
+from tqdm import tqdm  # noqa: E402
 
-from brainglobe_template_builder.io import (
+from brainglobe_template_builder.io import (  # noqa: E402
     file_path_with_suffix,
     load_tiff,
 )
-from brainglobe_template_builder.preproc.masking import create_mask
-from brainglobe_template_builder.preproc.splitting import (
-    generate_arrays_4template,
-    save_array_dict_to_nii,
+from brainglobe_template_builder.preproc.masking import (  # noqa: E402
+    create_mask,
+)
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from prep_utils import (  # noqa: E402
+    BackgroundWriter,
+    asr_to_ants,
+    hash_file,
+    initial_rigid_transform,
+    iter_template_arrays,
+    pad_image,
+    prep_setup,
+    save_template_arrays,
+    stage_key,
 )
 
 # %%
@@ -50,6 +81,15 @@ lowres = 50
 res_str = f"res-{lowres}um"
 # Define voxel sizes in mm (for Nifti saving)
 vox_sizes = [lowres * 1e-3] * 3  # in mm
+# The reoriented image is converted to ANTs in memory. Set this to True to
+# also save it as nifti (e.g. for inspection), at the cost of a gzip write.
+save_orig_nii = False
+# How to initialise the rigid registration to the target: None keeps the
+# ants.registration default (aligning the images' centres of mass),
+# "moments" aligns the principal axes of the brain masks (rotation and
+# translation only), and "coarse" first fits a rigid transform on 2x
+# downsampled images. Changing it changes the registration results.
+registration_init = None
 
 # Prepare directory structure
 atlas_dir = Path("/ceph/neuroinformatics/neuroinformatics/atlas-forge")
@@ -63,6 +103,32 @@ today = date.today()
 current_script_name = os.path.basename(__file__).replace(".py", "")
 logger.add(species_dir / "logs" / f"{today}_{current_script_name}.log")
 
+
+# %%
+# Set up caching, background writes and QC plotting
+# -------------------------------------------------
+# The outputs of the N4 correction, masking and registration stages are kept
+# in a content-addressed cache, keyed on the hash of the stage inputs and the
+# stage parameters. After all subjects are processed, the least recently used
+# entries are evicted until the cache fits in 20 GB. Each subject writes its
+# intermediate images through its own background writer (see below).
+# QC overlay plots are not rendered while subjects are processed. Instead,
+# downsampled previews of the plotted images are saved together with the
+# plot arguments, and all plots are rendered in parallel at the end of the
+# script (or later, by running the "Render QC plots" cell on its own).
+# Set render_qc to False to skip rendering, e.g. on batch runs.
+
+stage_cache, _, qc_plots = prep_setup(
+    deriv_dir,
+    current_script_name,
+    cache_size_gb=20,
+    evict_on_store=False,
+    background_writer=False,
+)
+render_qc = True
+n_qc_workers = n_workers
+
+
 # %%
 # Define registration target
 # --------------------------
@@ -76,15 +142,39 @@ logger.add(species_dir / "logs" / f"{today}_{current_script_name}.log")
 # and prepared the masks accordingly.
 
 target_dir = species_dir / "templates" / "template_asym_res-50um_n-3"
-target_image = ants.image_read(
-    (target_dir / "template_orig-asr_aligned.nii.gz").as_posix()
-)
-target_mask = ants.image_read(
-    (target_dir / "template_orig-asr_label-brain_aligned.nii.gz").as_posix()
-)
-target_halves_mask = ants.image_read(
-    (target_dir / "template_orig-asr_label-halves_aligned.nii.gz").as_posix()
-)
+# The registration stage depends on the target, so it is part of its cache key
+target_hashes = [
+    hash_file(target_dir / f"template_orig-asr{suffix}_aligned.nii.gz")
+    for suffix in ["", "_label-brain"]
+]
+
+# The arrays for template construction are padded with template_pad planes
+# of zeros on each side. The aligned images are resampled straight onto a
+# padded target grid, instead of being padded after resampling.
+template_pad = 2
+
+
+@cache
+def load_targets() -> dict[str, ants.ANTsImage]:
+    """Load the target images, once per worker process.
+
+    Workers are forked, and ITK's thread pools aren't safe to fork once
+    they're running, so the targets are only loaded (with ITK) in the
+    workers, never in the parent process.
+    """
+    image, mask, halves_mask = [
+        ants.image_read(
+            str(target_dir / f"template_orig-asr{suffix}_aligned.nii.gz")
+        )
+        for suffix in ["", "_label-brain", "_label-halves"]
+    ]
+    return {
+        "image": image,
+        "mask": mask,
+        "grid": pad_image(image, template_pad),
+        "halves_mask_padded": pad_image(halves_mask, template_pad),
+    }
+
 
 # %%
 # Load a dataframe with image paths to use for the template
@@ -104,12 +194,25 @@ df.head(n_subjects)
 # %%
 # Run the pipeline for each subject
 # ---------------------------------
+# Subjects are independent of each other (they only share the read-only
+# target images), so they are processed in parallel.
 
-# Create a dictionary to store the paths to the use4template directories
-# per subject. These will contain all necessary images for template building.
-use4template_dirs = {}
 
-for idx, row in tqdm(df.iterrows(), total=n_subjects):
+def process_subject(idx: int) -> tuple[Path, dict]:
+    """Run the pipeline for one subject.
+
+    Returns the subject's use4template dir and its transform registry entry.
+    Threads don't survive forking, so each subject gets its own writer,
+    which is closed (and its thread stopped) before the subject is done.
+    Writes still overlap with the remaining stages of the subject.
+    """
+    with BackgroundWriter() as writer:
+        return run_pipeline(idx, writer)
+
+
+def run_pipeline(idx: int, writer: BackgroundWriter) -> tuple[Path, dict]:
+    """Run the pipeline for one subject, writing intermediates via writer."""
+    targets = load_targets()
     # Figure out input-output paths
     row = df.iloc[idx]
     subject = "sub-" + row["subject_id"]
@@ -120,7 +223,6 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
 
     logger.info(f"Starting to process {file_prefix}...")
     logger.info(f"Will save outputs to {deriv_subj_dir}/")
-
     # Load the image
     image = load_tiff(tiff_path)
     logger.debug(f"Loaded image {tiff_path.name} with shape: {image.shape}.")
@@ -133,30 +235,56 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
     logger.debug(f"Reoriented image from {source_origin} to {target_origin}.")
     logger.debug(f"Reoriented image shape: {image_asr.shape}.")
 
-    # Save the reoriented image as nifti
+    # Convert the reoriented image to ANTs (optionally also save as nifti)
     nii_path = file_path_with_suffix(tiff_path, "_orig-asr", new_ext=".nii.gz")
-    save_as_asr_nii(image_asr, vox_sizes, nii_path)
-    logger.debug(f"Saved reoriented image as {nii_path.name}.")
+    image_ants = asr_to_ants(image_asr, vox_sizes)
+    if save_orig_nii:
+        save_as_asr_nii(image_asr, vox_sizes, nii_path)
+        logger.debug(f"Saved reoriented image as {nii_path.name}.")
 
     # Bias field correction (to homogenise intensities)
-    image_ants = ants.image_read(nii_path.as_posix())
-    image_n4 = ants.n4_bias_field_correction(image_ants)
+    n4_key = stage_key(
+        "n4",
+        hash_file(tiff_path),
+        source_origin=source_origin,
+        target_origin=target_origin,
+        vox_sizes=vox_sizes,
+    )
+    n4_entry = stage_cache.cached(
+        n4_key,
+        lambda entry: ants.image_write(
+            ants.n4_bias_field_correction(image_ants),
+            (entry / "image_n4.nii.gz").as_posix(),
+        ),
+    )
+    image_n4 = ants.image_read((n4_entry / "image_n4.nii.gz").as_posix())
     image_n4_path = file_path_with_suffix(nii_path, "_N4")
-    ants.image_write(image_n4, image_n4_path.as_posix())
+    writer.submit(shutil.copyfile, n4_entry / "image_n4.nii.gz", image_n4_path)
     logger.debug(
         f"Created N4 bias field corrected image as {image_n4_path.name}."
     )
 
     # Generate a brain mask based on the N4-corrected image
-    mask_data = create_mask(
-        image_n4.numpy(),
-        gauss_sigma=3,
-        threshold_method="triangle",
-        closing_size=5,
+    mask_params = {
+        "gauss_sigma": 3,
+        "threshold_method": "triangle",
+        "closing_size": 5,
+    }
+    mask_key = stage_key("mask", n4_key, **mask_params)
+    mask_entry = stage_cache.cached(
+        mask_key,
+        lambda entry: ants.image_write(
+            image_n4.new_image_like(
+                create_mask(image_n4.numpy(), **mask_params).astype(np.uint8)
+            ),
+            (entry / "mask.nii.gz").as_posix(),
+        ),
     )
     mask_path = file_path_with_suffix(nii_path, "_N4_mask")
-    mask = image_n4.new_image_like(mask_data.astype(np.uint8))
-    ants.image_write(mask, mask_path.as_posix())
+    mask = ants.image_read(
+        (mask_entry / "mask.nii.gz").as_posix(), pixeltype="unsigned char"
+    )
+    writer.submit(shutil.copyfile, mask_entry / "mask.nii.gz", mask_path)
     logger.debug(
         f"Generated brain mask with shape: {mask.shape} "
         f"and saved as {mask_path.name}."
@@ -166,7 +294,7 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
     mask_plot_path = (
         deriv_subj_dir / f"{file_prefix}_orig-asr_N4_mask-overlay.png"
     )
-    ants.plot(
+    qc_plots.record(
         image_n4,
         mask,
         overlay_alpha=0.5,
@@ -174,47 +302,85 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
         title="Brain mask over image",
         filename=mask_plot_path.as_posix(),
     )
-    logger.debug("Plotted overlay to visually check mask.")
+    logger.debug("Recorded overlay to visually check mask.")
 
     # Rigid-register the reoriented image to an already aligned target
     output_prefix = file_path_with_suffix(nii_path, "_N4_aligned_", new_ext="")
 
-    xfm = ants.registration(
-        fixed=target_image,
-        moving=image_n4,
-        mask=target_mask,
-        moving_mask=mask,
+    def register(entry: Path):
+        # the transforms are written to entry (outprefix), and read from there
+        ants.registration(
+            fixed=targets["image"],
+            moving=image_n4,
+            mask=targets["mask"],
+            moving_mask=mask,
+            type_of_transform="Rigid",
+            initial_transform=initial_rigid_transform(
+                registration_init,
+                targets["image"],
+                targets["mask"],
+                image_n4,
+                mask,
+                entry.as_posix() + "/",
+            ),
+            verbose=False,
+            outprefix=entry.as_posix() + "/",
+        )
+
+    registration_key = stage_key(
+        "registration",
+        n4_key,
+        mask_key,
+        *target_hashes,
         type_of_transform="Rigid",
-        initial_transform=None,
-        verbose=False,
-        outprefix=output_prefix.as_posix(),
+        registration_init=registration_init,
     )
+    registration_entry = stage_cache.cached(registration_key, register)
     logger.debug(
         "Aligned the reoriented image to the target via rigid registration."
     )
-    aligned_image = xfm["warpedmovout"]
-
-    # Ensure we only grab the correct transform (forward rigid)
-    rigid_transform = [
-        file_path
-        for file_path in xfm["fwdtransforms"]
-        if file_path.endswith("0GenericAffine.mat")
-    ]
-    assert len(rigid_transform) == 1, "Expected one affine transform."
 
-    # Transform the brain mask to the aligned image space
+    # Keep the forward rigid transform next to the other subject outputs
+    rigid_transform_path = output_prefix.as_posix() + "0GenericAffine.mat"
+    shutil.copyfile(
+        registration_entry / "0GenericAffine.mat", rigid_transform_path
+    )
+    rigid_transform = [rigid_transform_path]
+    registered_at = (registration_entry / "0GenericAffine.mat").stat().st_mtime
+    # relative, as derivatives may be mounted elsewhere on other nodes
+    transform_relpath = Path(rigid_transform_path).relative_to(deriv_dir)
+    transform_entry = {
+        "subject": subject,
+        "channel": row["color"],
+        "resolution_um": lowres,
+        "target": target_dir.name,
+        "type_of_transform": "Rigid",
+        "transform_path": transform_relpath.as_posix(),
+        "created": datetime.fromtimestamp(registered_at).isoformat(
+            timespec="seconds"
+        ),
+    }
+
+    # Transform the image and brain mask to the (padded) aligned image space
+    aligned_image = ants.apply_transforms(
+        fixed=targets["grid"],
+        moving=image_n4,
+        transformlist=rigid_transform,
+        interpolator="linear",
+    )
     aligned_mask = ants.apply_transforms(
-        fixed=target_image,
+        fixed=targets["grid"],
         moving=mask,
         transformlist=rigid_transform,
         interpolator="nearestNeighbor",
     )
-    logger.debug("Transformed brain mask to aligned space.")
+    logger.debug("Transformed image and brain mask to aligned space.")
 
     # Plot the aligned image over the target to check registration
-    ants.plot(
-        target_image,
+    qc_plots.record(
+        targets["grid"],
         aligned_image,
+        label_overlay=False,
         overlay_alpha=0.5,
         overlay_cmap="plasma",
         axis=1,
@@ -222,15 +388,15 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
         filename=output_prefix.as_posix() + "target-overlay.png",
     )
     # Plot the halves mask over the aligned image to check the split
-    ants.plot(
+    qc_plots.record(
         aligned_image,
-        target_halves_mask,
+        targets["halves_mask_padded"],
         overlay_alpha=0.5,
         axis=1,
         title="Aligned image split into right and left halves",
         filename=output_prefix.as_posix() + "halves-overlay.png",
     )
-    logger.debug("Plotted overlays to visually check alignment.")
+    logger.debug("Recorded overlays to visually check alignment.")
 
     # Generate arrays for template construction and save as niftis
     use4template_dir = Path(output_prefix.as_posix() + "padded_use4template")
@@ -241,15 +407,68 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
             file.unlink()
     use4template_dir.mkdir(exist_ok=True)
 
-    array_dict = generate_arrays_4template(
-        subject, aligned_image.numpy(), aligned_mask.numpy(), pad=2
+    template_arrays = iter_template_arrays(
+        subject,
+        aligned_image.numpy(),
+        aligned_mask.numpy(),
+        template_pad,
+        padded=True,
+    )
+    writer.submit(
+        save_template_arrays, template_arrays, use4template_dir, vox_sizes
     )
-    save_array_dict_to_nii(array_dict, use4template_dir, vox_sizes)
-    use4template_dirs[subject] = use4template_dir
     logger.info(
         f"Saved images for template construction in {use4template_dir}."
     )
+    writer.flush()
     logger.info(f"Finished processing {file_prefix}.")
+    return use4template_dir, transform_entry
+
+
+# Create a dictionary to store the paths to the use4template directories
+# per subject. These will contain all necessary images for template building.
+# Each worker loads the targets itself (see load_targets), and results are
+# collected in the order of the dataframe.
+with ProcessPoolExecutor(
+    max_workers=n_workers, mp_context=multiprocessing.get_context("fork")
+) as executor:
+    results = list(
+        tqdm(
+            executor.map(process_subject, range(n_subjects)),
+            total=n_subjects,
+        )
+    )
+subjects = "sub-" + df["subject_id"]
+use4template_dirs = {
+    subject: use4template_dir
+    for subject, (use4template_dir, _) in zip(subjects, results)
+}
+# Evict only once all workers are done, so they don't race each other
+stage_cache.evict()
+
+
+# %%
+# Update the transform registry
+# -----------------------------
+# Record each subject's rigid transform with its provenance (resolution,
+# target, creation time), so that later stages (e.g. 3_prep_highres.py) can
+# look it up instead of searching the subject directories. Entries from
+# earlier runs for the same subject, channel, resolution and target are
+# replaced.
+
+registry_path = deriv_dir / "transform_registry.csv"
+registry_keys = ["subject", "channel", "resolution_um", "target"]
+new_entries = pd.DataFrame([transform_entry for _, transform_entry in results])
+if registry_path.exists():
+    registry = pd.read_csv(registry_path)
+    replaced = registry.set_index(registry_keys).index.isin(
+        new_entries.set_index(registry_keys).index
+    )
+    registry = pd.concat([registry[~replaced], new_entries])
+else:
+    registry = new_entries
+registry.sort_values(registry_keys).to_csv(registry_path, index=False)
+logger.info(f"Recorded {len(new_entries)} transforms in {registry_path}.")
 
 
 # %%
@@ -319,3 +538,12 @@ for key, paths in filepath_lists.items():
     template_dir = species_dir / "templates" / template_name
     template_dir.mkdir(exist_ok=True)
     np.savetxt(template_dir / f"{label}_paths.txt", paths, fmt="%s")
+
+# %%
+# Render QC plots
+# ---------------
+# Render all recorded QC plots in parallel. Run this cell on its own to
+# render them later, if render_qc was False.
+
+if render_qc:
+    qc_plots.render_all(n_qc_workers)
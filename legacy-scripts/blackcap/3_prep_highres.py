@@ -4,7 +4,7 @@ Prepare high-resolution BlackCap images for template construction
 The following operations are performed on the lowest-resolution images to
 prepare them for template construction:
 - Upsample aligned space into high resolution
-- Import each image as tiff, re-orient to ASR and save as nifti
+- Import each image as tiff, re-orient to ASR and convert to ANTs in memory
 - Perform N4 Bias field correction using ANTs
 - Upsample from brain mask from lowres to highres
 - Transform the image and mask into the aligned space using existing transforms
@@ -17,6 +17,7 @@ prepare them for template construction:
 # Imports
 # -------
 import os
+import sys
 from datetime import date
 from pathlib import Path
 
@@ -29,9 +30,16 @@ from loguru import logger
 from tqdm import tqdm
 
 from brainglobe_template_builder.io import file_path_with_suffix, load_tiff
-from brainglobe_template_builder.preproc.splitting import (
-    generate_arrays_4template,
-    save_array_dict_to_nii,
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from prep_utils import (  # noqa: E402
+    asr_to_ants,
+    hash_file,
+    iter_template_arrays,
+    pad_image,
+    prep_setup,
+    save_template_arrays,
+    stage_key,
 )
 
 # %%
@@ -49,6 +57,9 @@ highres_str = f"res-{highres}um"
 # Define voxel sizes in mm (for Nifti saving)
 lowre_vox_sizes = [lowres * 1e-3] * 3  # in mm
 highres_vox_sizes = [highres * 1e-3] * 3  # in mm
+# The reoriented image is converted to ANTs in memory. Set this to True to
+# also save it as nifti (e.g. for inspection), at the cost of a gzip write.
+save_orig_nii = False
 
 # Prepare directory structure
 atlas_dir = Path("/media/ceph-niu/neuroinformatics/atlas-forge")
@@ -63,6 +74,27 @@ today = date.today()
 current_script_name = os.path.basename(__file__).replace(".py", "")
 logger.add(species_dir / "logs" / f"{today}_{current_script_name}.log")
 
+
+# %%
+# Set up caching, background writes and QC plotting
+# -------------------------------------------------
+# Intermediate images are written on a background thread, so that the next
+# compute stage doesn't wait for gzip compression. High-resolution images are
+# large, so only one write may wait in the queue: at most one image (or one
+# subject's template arrays) is held for writing while the next is computed.
+# QC overlay plots are not rendered while subjects are processed. Instead,
+# downsampled previews of the plotted images are saved together with the
+# plot arguments, and all plots are rendered in parallel at the end of the
+# script (or later, by running the "Render QC plots" cell on its own).
+# Set render_qc to False to skip rendering, e.g. on batch runs.
+
+_, writer, qc_plots = prep_setup(
+    deriv_dir, current_script_name, max_pending=1
+)
+render_qc = True
+n_qc_workers = 4
+
+
 # %%
 # Define registration target
 # --------------------------
@@ -87,21 +119,84 @@ target_halves_mask_lowres = ants.image_read(
 )
 
 # Upsample the targets to high resolution
+# The upsampled targets are cached in derivatives/.upsample_cache, keyed on
+# the contents of the lowres target and the upsampling parameters, so they
+# are only recomputed if the lowres target has changed.
 lowres_shape = target_image_lowres.shape
 factor = lowres // highres
 highres_shape = tuple([int(dim * factor) for dim in lowres_shape])
+upsample_cache_dir = deriv_dir / ".upsample_cache"
+upsample_cache_dir.mkdir(exist_ok=True)
+
+
+def upsample_target(
+    image_lowres: ants.ANTsImage, name: str, interp_type: int
+) -> ants.ANTsImage:
+    """Upsample a target image to highres, reusing a cached result."""
+    key = stage_key(
+        "upsample",
+        hash_file(target_dir / f"{name}.nii.gz"),
+        shape=highres_shape,
+        interp_type=interp_type,
+    )
+    highres_path = upsample_cache_dir / f"{name}_{highres_str}_{key}.nii.gz"
+    if highres_path.exists():
+        logger.debug(f"Reusing upsampled target {highres_path.name}.")
+        return ants.image_read(highres_path.as_posix())
+    image = ants.resample_image(
+        image_lowres, highres_shape, use_voxels=True, interp_type=interp_type
+    )
+    # write under a temporary name first, so an interrupted write isn't reused
+    tmp_path = highres_path.with_name(f"tmp_{highres_path.name}")
+    ants.image_write(image, tmp_path.as_posix())
+    tmp_path.rename(highres_path)
+    logger.debug(f"Upsampled target to {highres_path.name}.")
+    return image
+
+
 # For the image use B-spline interpolation (interp_type=4)
-target_image = ants.resample_image(
-    target_image_lowres, highres_shape, use_voxels=True, interp_type=4
+target_image = upsample_target(
+    target_image_lowres, "template_orig-asr_aligned", interp_type=4
 )
 # For masks use Nearest Neighbor interpolation (interp_type=1)
-target_mask = ants.resample_image(
-    target_mask_lowres, highres_shape, use_voxels=True, interp_type=1
+target_mask = upsample_target(
+    target_mask_lowres, "template_orig-asr_label-brain_aligned", interp_type=1
 )
-target_halves_mask = ants.resample_image(
-    target_halves_mask_lowres, highres_shape, use_voxels=True, interp_type=1
+target_halves_mask = upsample_target(
+    target_halves_mask_lowres,
+    "template_orig-asr_label-halves_aligned",
+    interp_type=1,
 )
 
+# The arrays for template construction are padded with template_pad planes
+# of zeros on each side. The aligned images are resampled straight onto a
+# padded target grid, instead of being padded after resampling.
+template_pad = 2
+target_grid = pad_image(target_image, template_pad)
+target_halves_mask_padded = pad_image(target_halves_mask, template_pad)
+
+# %%
+# Load the transform registry
+# ---------------------------
+# The rigid transforms to the target were estimated on the lowres images
+# by 2_prep_lowres.py, which records them in a registry together with their
+# provenance. They are reused here, so no registration is needed.
+# Subjects that are not in the registry (e.g. registered by an older
+# version of 2_prep_lowres.py) fall back to the transform file found in
+# their derivatives directory.
+
+registry_path = deriv_dir / "transform_registry.csv"
+if registry_path.exists():
+    registry = pd.read_csv(registry_path)
+    registry = registry[
+        (registry["resolution_um"] == lowres)
+        & (registry["target"] == target_dir.name)
+        & (registry["type_of_transform"] == "Rigid")
+    ]
+else:
+    logger.warning(f"No transform registry found at {registry_path}.")
+    registry = pd.DataFrame(columns=["subject", "channel"])
+
 # %%
 # Load a dataframe with image paths to use for the template
 # ---------------------------------------------------------
@@ -151,16 +246,17 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
     logger.debug(f"Reoriented image from {source_origin} to {target_origin}.")
     logger.debug(f"Reoriented image shape: {image_asr.shape}.")
 
-    # Save the reoriented image as nifti
+    # Convert the reoriented image to ANTs (optionally also save as nifti)
     nii_path = deriv_subj_dir / f"{file_prefix}_orig-asr.nii.gz"
-    save_as_asr_nii(image_asr, highres_vox_sizes, nii_path)
-    logger.debug(f"Saved reoriented image as {nii_path.name}.")
+    image_ants = asr_to_ants(image_asr, highres_vox_sizes)
+    if save_orig_nii:
+        save_as_asr_nii(image_asr, highres_vox_sizes, nii_path)
+        logger.debug(f"Saved reoriented image as {nii_path.name}.")
 
     # Bias field correction (to homogenise intensities)
-    image_ants = ants.image_read(nii_path.as_posix())
     image_n4 = ants.n4_bias_field_correction(image_ants)
     image_n4_path = file_path_with_suffix(nii_path, "_N4")
-    ants.image_write(image_n4, image_n4_path.as_posix())
+    writer.submit(ants.image_write, image_n4, image_n4_path.as_posix())
     logger.debug(
         f"Created N4 bias field corrected image as {image_n4_path.name}."
     )
@@ -175,7 +271,7 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
         mask_lowres, highres_shape, use_voxels=True, interp_type=1
     )
     mask_path = file_path_with_suffix(nii_path, "_N4_mask")
-    ants.image_write(mask, mask_path.as_posix())
+    writer.submit(ants.image_write, mask, mask_path.as_posix())
     logger.debug(
         f"Upsampled brain mask from {mask_lowres_path.name} "
         f"to {mask_path.name}."
@@ -185,7 +281,7 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
     mask_plot_path = (
         deriv_subj_dir / f"{file_prefix}_orig-asr_N4_mask-overlay.png"
     )
-    ants.plot(
+    qc_plots.record(
         image_n4,
         mask,
         overlay_alpha=0.5,
@@ -193,18 +289,42 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
         title="Brain mask over image",
         filename=mask_plot_path.as_posix(),
     )
-    logger.debug("Plotted overlay to visually check mask.")
+    logger.debug("Recorded overlay to visually check mask.")
 
     # Transform the reoriented image to an already aligned target
-    # find a file in deriv_subj_dir that ends with _0GenericAffine.mat
-    # this is the transform we want to use
-    transforms = list(deriv_subj_dir.glob("*_0GenericAffine.mat"))
-    rigid_transform = [transforms[0].as_posix()]
-    assert len(rigid_transform) == 1, "Expected one affine transform."
+    # look up the lowres rigid transform of this subject in the registry
+    transform_entry = registry[
+        (registry["subject"] == subject)
+        & (registry["channel"] == row["color"])
+    ]
+    assert (
+        len(transform_entry) <= 1
+    ), f"Expected one registered transform for {file_prefix_lowres}."
+    if len(transform_entry) == 1:
+        rigid_transform = [
+            (deriv_dir / transform_entry["transform_path"].iloc[0]).as_posix()
+        ]
+        logger.debug(
+            f"Using rigid transform {rigid_transform[0]}, created "
+            f"{transform_entry['created'].iloc[0]}."
+        )
+    else:
+        # find the file in deriv_subj_dir that ends with _0GenericAffine.mat
+        transforms = list(deriv_subj_dir.glob("*_0GenericAffine.mat"))
+        assert len(transforms) == 1, (
+            f"{file_prefix_lowres} is not in the transform registry, and "
+            f"{len(transforms)} affine transforms were found in "
+            f"{deriv_subj_dir} instead of one."
+        )
+        rigid_transform = [transforms[0].as_posix()]
+        logger.warning(
+            f"{file_prefix_lowres} is not in the transform registry, "
+            f"using {transforms[0].name} instead."
+        )
 
     # Transform the image to the aligned space
     aligned_image = ants.apply_transforms(
-        fixed=target_image,
+        fixed=target_grid,
         moving=image_n4,
         transformlist=rigid_transform,
         interpolator="bSpline",
@@ -213,7 +333,7 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
 
     # Transform the brain mask to the aligned image space
     aligned_mask = ants.apply_transforms(
-        fixed=target_image,
+        fixed=target_grid,
         moving=mask,
         transformlist=rigid_transform,
         interpolator="nearestNeighbor",
@@ -222,9 +342,10 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
 
     output_prefix = file_path_with_suffix(nii_path, "_N4_aligned_", new_ext="")
     # Plot the aligned image over the target to check registration
-    ants.plot(
-        target_image,
+    qc_plots.record(
+        target_grid,
         aligned_image,
+        label_overlay=False,
         overlay_alpha=0.5,
         overlay_cmap="plasma",
         axis=1,
@@ -232,15 +353,15 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
         filename=output_prefix.as_posix() + "target-overlay.png",
     )
     # Plot the halves mask over the aligned image to check the split
-    ants.plot(
+    qc_plots.record(
         aligned_image,
-        target_halves_mask,
+        target_halves_mask_padded,
         overlay_alpha=0.5,
         axis=1,
         title="Aligned image split into right and left halves",
         filename=output_prefix.as_posix() + "halves-overlay.png",
     )
-    logger.debug("Plotted overlays to visually check alignment.")
+    logger.debug("Recorded overlays to visually check alignment.")
 
     # Generate arrays for template construction and save as niftis
     use4template_dir = Path(output_prefix.as_posix() + "padded_use4template")
@@ -251,10 +372,19 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
             file.unlink()
     use4template_dir.mkdir(exist_ok=True)
 
-    array_dict = generate_arrays_4template(
-        subject, aligned_image.numpy(), aligned_mask.numpy(), pad=2
+    template_arrays = iter_template_arrays(
+        subject,
+        aligned_image.numpy(),
+        aligned_mask.numpy(),
+        template_pad,
+        padded=True,
+    )
+    writer.submit(
+        save_template_arrays,
+        template_arrays,
+        use4template_dir,
+        highres_vox_sizes,
     )
-    save_array_dict_to_nii(array_dict, use4template_dir, highres_vox_sizes)
     use4template_dirs[subject] = use4template_dir
     logger.info(
         f"Saved images for template construction in {use4template_dir}."
@@ -322,6 +452,10 @@ for _, row in df.iterrows():
 # %%
 # Save the file paths to text files, each in a separate directory
 
+# Make sure all images are on disk before they are listed, and stop the
+# writer thread before QC plots are rendered in forked processes
+writer.close()
+
 for key, paths in filepath_lists.items():
     kind, label = key.split("-")  # e.g. "asym" and "brain"
     n_images = len(paths)
@@ -329,3 +463,12 @@ for key, paths in filepath_lists.items():
     template_dir = species_dir / "templates" / template_name
     template_dir.mkdir(exist_ok=True)
     np.savetxt(template_dir / f"{label}_paths.txt", paths, fmt="%s")
+
+# %%
+# Render QC plots
+# ---------------
+# Render all recorded QC plots in parallel. Run this cell on its own to
+# render them later, if render_qc was False.
+
+if render_qc:
+    qc_plots.render_all(n_qc_workers)
@@ -93,8 +93,17 @@ atlas_reference_file = output_dir / f"reference_{res_str}_image.nii.gz"
 save_as_asr_nii(template_padded, vox_sizes, atlas_reference_file)
 logger.debug(f"Saved atlas reference image as {atlas_reference_file.name}.")
 
+# Convert the padded template to ANTs in memory, with the header that
+# save_as_asr_nii writes (ITK reads the nifti RAS axes as LPS), rather than
+# reading the file we just wrote back in
+atlas_reference = ants.from_numpy(
+    template_padded.astype(np.float32),
+    origin=(0.0, 0.0, 0.0),
+    spacing=tuple(vox_sizes),
+    direction=np.diag([-1.0, -1.0, 1.0]),
+)
+
 # Plot the atlas reference image to check
-atlas_reference = ants.image_read(atlas_reference_file.as_posix())
 ants.plot(
     atlas_reference,
     axis=1,
@@ -1,4 +1,5 @@
 import argparse
+import sys
 from pathlib import Path
 
 import ants
@@ -17,6 +18,9 @@ from brainglobe_template_builder.preproc.wingdisc_utils import (
     resize_anisotropic_image_stack,
 )
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from prep_utils import asr_to_ants  # noqa: E402
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Download source image")
     parser.add_argument(
@@ -153,7 +157,7 @@ if __name__ == "__main__":
             f"saved as {downsampled_filename}"
         )
 
-        # Save the downsampled,filtered and padded image as nifti
+        # The nifti is only written once the image has been normalised below
         nii_path = file_path_with_suffix(
             saving_path,
             f"_downsampled_filtered_padded_normalized_{dataset}",
@@ -162,13 +166,9 @@ if __name__ == "__main__":
         vox_sizes = [
             target_isotropic_resolution,
         ] * 3
-        save_as_asr_nii(mf_image, vox_sizes, nii_path)
-        logger.info(
-            f"Saved downsampled and filtered image as {nii_path.name}."
-        )
 
         # Generate the wingdisc mask
-        image_ants = ants.image_read(nii_path.as_posix())
+        image_ants = asr_to_ants(mf_image, vox_sizes)
         mask_data = create_mask(
             image_ants.numpy(),
             gauss_sigma=1,
@@ -191,7 +191,7 @@ if __name__ == "__main__":
         # Normalized the image
         normalised_image = normalize_planes_by_mean(mf_image, percentile=0.1)
         save_as_asr_nii(normalised_image, vox_sizes, nii_path)
-        logger.info("replace the pre-saved nii.gz image as normalized image.")
+        logger.info(f"Saved normalized image as {nii_path.name}.")
 
         # Plot the mask over the image to check
         mask_plot_path = (
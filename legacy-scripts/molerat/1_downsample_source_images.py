@@ -1,4 +1,6 @@
 import argparse
+import json
+import sys
 from pathlib import Path
 
 import numpy as np
@@ -10,6 +12,100 @@ from skimage import transform
 
 from brainglobe_template_builder.plots import plot_grid, plot_orthographic
 
+# the shared helpers live in the atlas_forge package at the root of the repo
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from atlas_forge.figures import cached_figure, figure_key  # noqa: E402
+from atlas_forge.multiscale import build_pyramid, save_ome_zarr  # noqa: E402
+
+
+def downscale_mirrored(hemisphere, factors):
+    """Downscale a hemisphere as if it was mirrored along axis 0 first.
+
+    Gives the same result as ``downscale_local_mean`` on
+    ``np.concatenate((hemisphere, np.flip(hemisphere, axis=0)))`` (so the
+    midline isn't blurred by zeros), without building that full-resolution
+    volume. Only the block straddling the midline mixes both halves.
+    Hemispheres thinner than one block are mirrored in full instead.
+    """
+    factor = factors[0]
+    n_planes = hemisphere.shape[0]
+    if n_planes < factor:
+        # every block straddles the midline, so just build the mirrored stack
+        mirrored = np.concatenate((hemisphere, np.flip(hemisphere, axis=0)))
+        return transform.downscale_local_mean(mirrored, factors)
+    remainder = n_planes % factor
+    near = transform.downscale_local_mean(
+        hemisphere[: n_planes - remainder], factors
+    )
+    if remainder == 0:
+        # blocks line up with the midline, so the far half is a mirror image
+        return np.concatenate((near, np.flip(near, axis=0)))
+
+    mirrored = np.flip(hemisphere, axis=0)  # a view, not a copy
+    straddling = np.concatenate(
+        (hemisphere[n_planes - remainder :], mirrored[: factor - remainder])
+    )
+    midline = transform.downscale_local_mean(straddling, factors)
+    if 2 * remainder == factor:
+        # the far half's blocks are the near half's blocks, mirrored
+        far = np.flip(near, axis=0)
+    else:
+        far = transform.downscale_local_mean(
+            mirrored[factor - remainder :], factors
+        )
+    return np.concatenate((near, midline, far))
+
+
+def nonzero_bounding_box(stack):
+    """Find the non-zero extent of a stack along each axis.
+
+    Returns a (start, stop) pair per axis, e.g. for slicing. The projections
+    onto the axes come from two reductions over the stack, which reduce the
+    values directly instead of building a boolean copy of the stack; for a
+    dask array they are computed together, chunk by chunk.
+    """
+    # project onto the first two axes, then derive both from that
+    first_two = np.any(stack, axis=2)
+    projections = [first_two.any(axis=1), first_two.any(axis=0)]
+    projections.append(np.any(stack, axis=(0, 1)))
+    if hasattr(stack, "dask"):
+        import dask
+
+        projections = dask.compute(*projections)
+    bounding_box = []
+    for projection in projections:
+        indices = np.flatnonzero(projection)
+        if indices.size == 0:
+            bounding_box.append((0, 0))
+        else:
+            bounding_box.append((int(indices[0]), int(indices[-1]) + 1))
+    return bounding_box
+
+
+def plot_preview(plot, stack, save_path, factor, cache_dir, **kwargs):
+    """Plot a strided preview of a volume, caching the resulting figure.
+
+    ``plot`` (e.g. ``plot_grid`` or ``plot_orthographic``) is called on every
+    ``factor``-th voxel along each axis, and saves the figure as a png and a
+    pdf named after ``save_path`` (up to its first dot, as ``plot`` does).
+    Figures are cached per volume hash and plot parameters, so re-plotting an
+    unchanged volume is just a copy of both files.
+    """
+    key = figure_key(stack, plot.__name__, factor, kwargs)
+
+    def plot_to_cache(cache_dir, key):
+        preview = stack[::factor, ::factor, ::factor]
+        plot(preview, save_path=cache_dir / f"{key}.png", **kwargs)
+
+    cached_figure(
+        key,
+        cache_dir,
+        save_path.parent,
+        save_path.name.split(".")[0],
+        plot_to_cache,
+    )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Downsample source images")
     parser.add_argument(
@@ -22,9 +118,25 @@ if __name__ == "__main__":
     parser.add_argument(
         "--target_isotropic_resolution",
         type=int,
-        help="Target isotropic resolution",
+        nargs="+",
+        help="Target isotropic resolution. If several are given (e.g. 20 40)"
+        ", each is derived from the previous one in the same pass.",
         required=True,
     )
+    parser.add_argument(
+        "--output_format",
+        choices=["tif", "ome-zarr"],
+        default="tif",
+        help="Save a tif per target resolution, or a multiscale OME-Zarr "
+        "with one level per target resolution",
+    )
+    parser.add_argument(
+        "--plot_preview_factor",
+        type=int,
+        default=1,
+        help="Plot every n-th voxel along each axis of the downsampled "
+        "images, e.g. 4 for quicker previews (default: full resolution)",
+    )
 
     args = parser.parse_args()
 
@@ -35,7 +147,8 @@ if __name__ == "__main__":
     source_info_file = atlas_forge_molerat_path / "molerat_brains_info_PM.csv"
 
     template_building_root = Path(args.template_building_root)
-    target_isotropic_resolution = int(args.target_isotropic_resolution)
+    target_isotropic_resolutions = args.target_isotropic_resolution
+    target_isotropic_resolution = target_isotropic_resolutions[0]
 
     in_plane_resolution = 20
     out_of_plane_resolution = 20
@@ -70,11 +183,7 @@ if __name__ == "__main__":
             template_raw_data / f"sub-{subject_id}_hemi-{hemisphere}"
         )
         subject_folder.mkdir(exist_ok=True)
-        rawdata_filename = (
-            f"sub-{subject_id}_"
-            f"hemi-{hemisphere}_"
-            f"res-{target_isotropic_resolution}um.tif"
-        )
+        subject_prefix = f"sub-{subject_id}_hemi-{hemisphere}"
 
         # we can't use our usual transform utils function here,
         # because it's not a dask array,
@@ -89,40 +198,65 @@ if __name__ == "__main__":
                 f"Flipping left hemisphere to right for {str(source_file)}"
             )
             stack = np.flip(stack, axis=0)
-        # Find the last few slices of stack that contain all zeros
-        zero_slices = 0
-        for i in range(stack.shape[0] - 1, -1, -1):
-            if np.all(stack[i] == 0):
-                zero_slices += 1
-            else:
-                break
-        if zero_slices:
-            logger.info(f"Last zero slices: {zero_slices}")
-            stack = stack[: stack.shape[0] - zero_slices, :, :]
+        # Crop the stack to its non-zero bounding box, and keep the offsets
+        # so the crop can be undone (by zero-padding the RPI stack, after
+        # the flip above, with bounding_box[i][0] voxels before and
+        # shape[i] - bounding_box[i][1] voxels after along each axis i)
+        bounding_box = nonzero_bounding_box(stack)
+        crop_info = {
+            "orientation": "RPI",
+            "flipped": sample["looks_like_right_hemisphere"] == "no",
+            "shape": list(stack.shape),
+            "bounding_box": bounding_box,
+        }
+        crop_path = subject_folder / f"{subject_prefix}_crop.json"
+        crop_path.write_text(json.dumps(crop_info, indent=2))
+        logger.info(f"Cropping to non-zero bounding box: {bounding_box}")
+        stack = stack[tuple(slice(*extent) for extent in bounding_box)]
 
         # mirror BEFORE downsampling
         # (because otherwise midline gets blurred by zeros!)
-        stack = np.concatenate((stack, np.flip(stack, axis=0)), axis=0)
+        # downscale_mirrored does this without building the mirrored stack
         if target_isotropic_resolution != 20:
-            downsampled = transform.downscale_local_mean(
+            downsampled = downscale_mirrored(
                 stack, (axial_factor, in_plane_factor, in_plane_factor)
             )
         else:
             logger.info("No downsampling needed!")
-            downsampled = stack
+            downsampled = np.concatenate(
+                (stack, np.flip(stack, axis=0)), axis=0
+            )
         original_space = AnatomicalSpace("RPI")
         downsampled = original_space.map_stack_to("ASR", downsampled)
-        save_any(downsampled, subject_folder / rawdata_filename)
+        levels = build_pyramid(downsampled, target_isotropic_resolutions)
+        if args.output_format == "ome-zarr":
+            zarr_path = subject_folder / f"{subject_prefix}.ome.zarr"
+            save_ome_zarr(levels, zarr_path)
 
         plots_folder = (
             Path.home() / "dev/brainglobe-template-builder/test-images/"
         )
-        plot_grid(
-            downsampled,
-            save_path=plots_folder / f"grid-{rawdata_filename}.png",
-        )
-        plot_orthographic(
-            downsampled,
-            save_path=plots_folder / f"ortho-{rawdata_filename}.png",
-        )
-        logger.info(f"{rawdata_filename} downsampled.")
+        plots_cache = plots_folder / ".plot_cache"
+        factor = args.plot_preview_factor
+        for resolution, level in levels.items():
+            rawdata_filename = f"{subject_prefix}_res-{resolution}um.tif"
+            if args.output_format == "tif":
+                save_any(level, subject_folder / rawdata_filename)
+            plot_preview(
+                plot_grid,
+                level,
+                plots_folder / f"grid-{rawdata_filename}.png",
+                factor,
+                plots_cache,
+            )
+            # fewer voxels along each ray of the preview, so attenuate more
+            # per voxel (0.01 is plot_orthographic's default)
+            plot_preview(
+                plot_orthographic,
+                level,
+                plots_folder / f"ortho-{rawdata_filename}.png",
+                factor,
+                plots_cache,
+                mip_attenuation=0.01 * factor,
+            )
+            logger.info(f"{rawdata_filename} downsampled.")
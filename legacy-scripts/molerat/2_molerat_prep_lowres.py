@@ -6,12 +6,17 @@ prepare them for template construction:
 - Perform N4 Bias field correction using ANTs
 - Generate brain mask based on N4-corrected image
 - Save all resulting images as nifti files to be used for template construction
+
+N4 correction and masking results are cached per subject, so re-running the
+script only recomputes what changed (e.g. a new subject).
 """
 
 # %%
 # Imports
 # -------
 import os
+import shutil
+import sys
 from datetime import date
 from pathlib import Path
 
@@ -22,9 +27,15 @@ from loguru import logger
 
 from brainglobe_template_builder.io import file_path_with_suffix, load_tiff
 from brainglobe_template_builder.preproc.masking import create_mask
-from brainglobe_template_builder.preproc.splitting import (
-    get_right_and_left_slices,
-    save_array_dict_to_nii,
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from prep_utils import (  # noqa: E402
+    asr_to_ants,
+    hash_file,
+    iter_mirrored_template_arrays,
+    prep_setup,
+    save_template_arrays,
+    stage_key,
 )
 
 # %%
@@ -39,6 +50,9 @@ lowres = 40
 res_str = f"res-{lowres}um"
 # Define voxel sizes in mm (for Nifti saving)
 vox_sizes = [lowres * 1e-3] * 3  # in mm
+# The reoriented image is converted to ANTs in memory. Set this to True to
+# also save it as nifti (e.g. for inspection), at the cost of a gzip write.
+save_orig_nii = False
 
 # Prepare directory structure
 atlas_dir = Path("/media/ceph/neuroinformatics/neuroinformatics/atlas-forge")
@@ -55,6 +69,26 @@ current_script_name = os.path.basename(__file__).replace(".py", "")
 logger.add(species_dir / "logs" / f"{today}_{current_script_name}.log")
 
 
+# %%
+# Set up caching, background writes and QC plotting
+# -------------------------------------------------
+# The outputs of the N4 correction and masking stages are kept in a
+# content-addressed cache, keyed on the hash of the stage inputs and the stage
+# parameters, and limited to 20 GB. Intermediate images are written on a
+# background thread, which is flushed before any cache entry is evicted.
+# QC overlay plots are not rendered while subjects are processed. Instead,
+# downsampled previews of the plotted images are saved together with the
+# plot arguments, and all plots are rendered in parallel at the end of the
+# script (or later, by running the "Render QC plots" cell on its own).
+# Set render_qc to False to skip rendering, e.g. on batch runs.
+
+stage_cache, writer, qc_plots = prep_setup(
+    deriv_dir, current_script_name, cache_size_gb=20
+)
+render_qc = True
+n_qc_workers = 4
+
+
 # %%
 # Run the pipeline for each subject
 # ---------------------------------
@@ -80,32 +114,52 @@ for raw_subj_dir in raw_dir.iterdir():
         f"Loaded image {raw_tiff_path.name} with shape: {image.shape}."
     )
 
-    # Save the image as nifti
+    # Convert the image to ANTs (optionally also save as nifti)
     nii_path = file_path_with_suffix(
         deriv_subj_dir / f"{file_prefix}.tif", "_orig-asr", new_ext=".nii.gz"
     )
-    save_as_asr_nii(image, vox_sizes, nii_path)
-    logger.debug(f"Saved reoriented image as {nii_path.name}.")
+    image_ants = asr_to_ants(image, vox_sizes)
+    if save_orig_nii:
+        save_as_asr_nii(image, vox_sizes, nii_path)
+        logger.debug(f"Saved reoriented image as {nii_path.name}.")
 
     # Bias field correction (to homogenise intensities)
-    image_ants = ants.image_read(nii_path.as_posix())
-    image_n4 = ants.n4_bias_field_correction(image_ants)
+    n4_key = stage_key("n4", hash_file(raw_tiff_path), vox_sizes=vox_sizes)
+    n4_entry = stage_cache.cached(
+        n4_key,
+        lambda entry: ants.image_write(
+            ants.n4_bias_field_correction(image_ants),
+            (entry / "image_n4.nii.gz").as_posix(),
+        ),
+    )
+    image_n4 = ants.image_read((n4_entry / "image_n4.nii.gz").as_posix())
     image_n4_path = file_path_with_suffix(nii_path, "_N4")
-    ants.image_write(image_n4, image_n4_path.as_posix())
+    writer.submit(shutil.copyfile, n4_entry / "image_n4.nii.gz", image_n4_path)
     logger.debug(
         f"Created N4 bias field corrected image as {image_n4_path.name}."
     )
 
     # Generate a brain mask based on the N4-corrected image
-    mask_data = create_mask(
-        image_n4.numpy(),
-        gauss_sigma=3,
-        threshold_method="triangle",
-        closing_size=5,
+    mask_params = {
+        "gauss_sigma": 3,
+        "threshold_method": "triangle",
+        "closing_size": 5,
+    }
+    mask_key = stage_key("mask", n4_key, **mask_params)
+    mask_entry = stage_cache.cached(
+        mask_key,
+        lambda entry: ants.image_write(
+            image_n4.new_image_like(
+                create_mask(image_n4.numpy(), **mask_params).astype(np.uint8)
+            ),
+            (entry / "mask.nii.gz").as_posix(),
+        ),
     )
     mask_path = file_path_with_suffix(nii_path, "_N4_mask")
-    mask = image_n4.new_image_like(mask_data.astype(np.uint8))
-    ants.image_write(mask, mask_path.as_posix())
+    mask = ants.image_read(
+        (mask_entry / "mask.nii.gz").as_posix(), pixeltype="unsigned char"
+    )
+    writer.submit(shutil.copyfile, mask_entry / "mask.nii.gz", mask_path)
     logger.debug(
         f"Generated brain mask with shape: {mask.shape} "
         f"and saved as {mask_path.name}."
@@ -115,7 +169,7 @@ for raw_subj_dir in raw_dir.iterdir():
     mask_plot_path = (
         deriv_subj_dir / f"{file_prefix}_orig-asr_N4_mask-overlay.png"
     )
-    ants.plot(
+    qc_plots.record(
         image_n4,
         mask,
         overlay_alpha=0.5,
@@ -123,7 +177,7 @@ for raw_subj_dir in raw_dir.iterdir():
         title="Brain mask over image",
         filename=mask_plot_path.as_posix(),
     )
-    logger.debug("Plotted overlay to visually check mask.")
+    logger.debug("Recorded overlay to visually check mask.")
 
     output_prefix = file_path_with_suffix(nii_path, "_N4_aligned_", new_ext="")
     # Generate arrays for template construction and save as niftis
@@ -137,23 +191,12 @@ for raw_subj_dir in raw_dir.iterdir():
 
     image_n4 = image_n4.numpy()
     mask = mask.numpy()
-    right_hemi_slices, _ = get_right_and_left_slices(image_n4)
-
-    array_dict = {
-        f"{use4template_dir}/{file_prefix}_sym-brain": np.pad(
-            image_n4, pad_width=2, mode="constant"
-        ),
-        f"{use4template_dir}/{file_prefix}_sym-mask": np.pad(
-            mask, pad_width=2, mode="constant"
-        ),
-        f"{use4template_dir}/{file_prefix}_right-hemi-brain": np.pad(
-            image_n4[right_hemi_slices], pad_width=2, mode="constant"
-        ),
-        f"{use4template_dir}/{file_prefix}_right-hemi-mask": np.pad(
-            mask[right_hemi_slices], pad_width=2, mode="constant"
-        ),
-    }
-    save_array_dict_to_nii(array_dict, use4template_dir, vox_sizes)
+    template_arrays = iter_mirrored_template_arrays(
+        f"{use4template_dir}/{file_prefix}", image_n4, mask, pad=2
+    )
+    writer.submit(
+        save_template_arrays, template_arrays, use4template_dir, vox_sizes
+    )
     use4template_dirs[file_prefix] = use4template_dir
     logger.info(
         f"Saved images for template construction in {use4template_dir}."
@@ -194,6 +237,10 @@ for subject, use4template_dir in use4template_dirs.items():
 # %%
 # Save the file paths to text files, each in a separate directory
 
+# Make sure all images are on disk before they are listed, and stop the
+# writer thread before QC plots are rendered in forked processes
+writer.close()
+
 for key, paths in filepath_lists.items():
     kind, label = key.split("-")  # e.g. "asym" and "brain"
     n_images = len(paths)
@@ -203,3 +250,12 @@ for key, paths in filepath_lists.items():
     np.savetxt(template_dir / f"{label}_paths.txt", paths, fmt="%s")
 
 # %%
+# Render QC plots
+# ---------------
+# Render all recorded QC plots in parallel. Run this cell on its own to
+# render them later, if render_qc was False.
+
+if render_qc:
+    qc_plots.render_all(n_qc_workers)
+
+# %%
@@ -0,0 +1,524 @@
+"""
+Helpers shared by the legacy prep scripts
+=========================================
+The blackcap, drosophila, molerat and tadpole prep scripts import this
+module after putting the ``legacy-scripts`` folder on ``sys.path``. It
+holds:
+- Conversion and padding of ASR arrays and ANTs images
+- Initialisation of the rigid registration to a target
+- Lazy generation and saving of the arrays for template construction
+- A content-addressed cache of per-subject stage outputs
+- A background writer for intermediate images
+- Deferred (recorded, then rendered in parallel) QC overlay plots
+- The setup of the above shared by the prep scripts
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import threading
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import ants
+import numpy as np
+from loguru import logger
+
+from brainglobe_template_builder.preproc.splitting import (
+    get_right_and_left_slices,
+    save_array_dict_to_nii,
+)
+
+# %%
+# Images and arrays
+# -----------------
+
+
+def asr_to_ants(stack: np.ndarray, vox_sizes: list[float]) -> ants.ANTsImage:
+    """Convert an ASR array to an ANTsImage in memory.
+
+    The result has the same header as saving the array with
+    ``save_as_asr_nii`` and reading it back with ``ants.image_read``
+    (ITK reads the nifti RAS axes as LPS, hence the flipped direction).
+    """
+    return ants.from_numpy(
+        stack.astype(np.float32),
+        origin=(0.0, 0.0, 0.0),
+        spacing=tuple(vox_sizes),
+        direction=np.diag([-1.0, -1.0, 1.0]),
+    )
+
+
+def pad_image(image: ants.ANTsImage, pad: int) -> ants.ANTsImage:
+    """Zero-pad an ANTsImage on each side, keeping its physical position."""
+    spacing = np.array(image.spacing)
+    origin = np.array(image.origin) - image.direction @ (spacing * pad)
+    return ants.from_numpy(
+        np.pad(image.numpy(), pad_width=pad, mode="constant"),
+        origin=tuple(origin),
+        spacing=image.spacing,
+        direction=image.direction,
+    )
+
+
+def initial_rigid_transform(
+    method: str | None,
+    fixed: ants.ANTsImage,
+    fixed_mask: ants.ANTsImage,
+    moving: ants.ANTsImage,
+    moving_mask: ants.ANTsImage,
+    outprefix: str,
+) -> str | None:
+    """Estimate an initial transform for a rigid ants.registration.
+
+    ``method`` None returns None, which lets ants.registration align the
+    centres of mass of the images, as it does by default. "moments" aligns
+    the principal axes of the masks (rotation and translation only), and
+    "coarse" fits a rigid transform on 2x downsampled images and masks.
+    Returns the path to the initial transform, written with ``outprefix``.
+    """
+    if method is None:
+        return None
+    if method == "moments":
+        # align the principal axes of the masks, then search nearby rotations
+        init_path = ants.affine_initializer(
+            fixed_mask.clone("float"),
+            moving_mask.clone("float"),
+            use_principal_axis=True,
+            txfn=outprefix + "init.mat",
+        )
+        # The initializer fits a full affine transform, which may scale or
+        # shear. Keep it rigid: replace its matrix with the nearest rotation
+        # (keeping the translation and centre).
+        init = ants.read_transform(init_path)
+        parameters = np.asarray(init.parameters, dtype=float)
+        u, _, vt = np.linalg.svd(parameters[:9].reshape(3, 3))
+        rotation = u @ np.diag([1.0, 1.0, np.linalg.det(u @ vt)]) @ vt
+        init.set_parameters(np.concatenate([rotation.ravel(), parameters[9:]]))
+        ants.write_transform(init, init_path)
+        return init_path
+    if method == "coarse":
+
+        def coarse(image: ants.ANTsImage, interp_type: int):
+            spacing = [s * 2 for s in image.spacing]
+            return ants.resample_image(image, spacing, interp_type=interp_type)
+
+        # linear interpolation (0) for images, nearest neighbour (1) for masks
+        xfm = ants.registration(
+            fixed=coarse(fixed, 0),
+            moving=coarse(moving, 0),
+            mask=coarse(fixed_mask, 1),
+            moving_mask=coarse(moving_mask, 1),
+            type_of_transform="Rigid",
+            verbose=False,
+            outprefix=outprefix + "coarse_",
+        )
+        return xfm["fwdtransforms"][0]
+    raise ValueError(f"Unknown rigid initialisation method: {method}")
+
+
+# %%
+# Arrays for template construction
+# --------------------------------
+# Each variant is generated and written one at a time, to keep peak memory
+# at about one volume.
+
+
+def pad_into(parts: list[np.ndarray], pad: int) -> np.ndarray:
+    """Zero-pad the concatenation of parts (along axis 2) in one allocation.
+
+    Same as ``np.pad(np.dstack(parts), pad)``, without the intermediate.
+    """
+    shape = list(parts[0].shape)
+    shape[2] = sum(part.shape[2] for part in parts)
+    padded = np.zeros([n + 2 * pad for n in shape], dtype=parts[0].dtype)
+    start = pad
+    for part in parts:
+        stop = start + part.shape[2]
+        padded[pad : pad + shape[0], pad : pad + shape[1], start:stop] = part
+        start = stop
+    return padded
+
+
+def iter_template_arrays(
+    subject: str,
+    image: np.ndarray,
+    mask: np.ndarray,
+    pad: int,
+    padded: bool = False,
+) -> Iterator[tuple[str, np.ndarray]]:
+    """Generate the arrays for template construction one at a time.
+
+    Mirrors ``generate_arrays_4template(subject, image, mask, pad)``, but
+    slices and flips the hemispheres as views and yields each padded
+    variant as soon as it is built, so that only one of them is in memory
+    at once.
+
+    If ``padded`` is True, the arrays already have ``pad`` planes on each
+    side (e.g. resampled onto a padded grid). Their border is zeroed in
+    place and they are yielded as the asym arrays as is.
+    """
+    for label, array in {"brain": image, "mask": mask}.items():
+        if padded:
+            for axis in range(3):
+                np.moveaxis(array, axis, 0)[:pad] = 0
+                np.moveaxis(array, axis, 0)[-pad:] = 0
+            asym = array
+            array = array[pad:-pad, pad:-pad, pad:-pad]
+        else:
+            asym = pad_into([array], pad)
+        right_slices, left_slices = get_right_and_left_slices(array)
+        right, left = array[right_slices], array[left_slices]
+        left_xflip = np.flip(left, 2)
+        yield f"{subject}_asym-{label}", asym
+        yield f"{subject}_right-hemi-{label}", pad_into([right], pad)
+        yield f"{subject}_left-hemi-xflip-{label}", pad_into([left_xflip], pad)
+        yield f"{subject}_right-sym-{label}", pad_into(
+            [right, np.flip(right, 2)], pad
+        )
+        yield f"{subject}_left-sym-{label}", pad_into([left_xflip, left], pad)
+
+
+def iter_mirrored_template_arrays(
+    prefix: str, image: np.ndarray, mask: np.ndarray, pad: int
+) -> Iterator[tuple[str, np.ndarray]]:
+    """Generate the padded arrays of an already mirrored brain one at a time.
+
+    Yields (name, array) pairs lazily, so only one array is in memory at
+    a time: the whole (already mirrored) brain and its right hemisphere.
+    """
+    right_hemi_slices, _ = get_right_and_left_slices(image)
+    for label, array in {"brain": image, "mask": mask}.items():
+        yield f"{prefix}_sym-{label}", pad_into([array], pad)
+        yield f"{prefix}_right-hemi-{label}", pad_into(
+            [array[right_hemi_slices]], pad
+        )
+
+
+def save_template_arrays(
+    arrays: Iterator[tuple[str, np.ndarray]],
+    save_dir: Path,
+    vox_sizes: list[float],
+):
+    """Save each array as nifti as soon as it is generated.
+
+    Like ``save_array_dict_to_nii``, but only one array is in memory at once.
+    """
+    for name, array in arrays:
+        save_array_dict_to_nii({name: array}, save_dir, vox_sizes)
+
+
+# %%
+# Stage cache
+# -----------
+# Stage outputs are kept in a content-addressed cache: each entry is keyed on
+# the hash of the stage inputs and the stage parameters. The least recently
+# used entries are evicted once the cache grows beyond its size budget.
+
+
+def hash_file(file_path: Path) -> str:
+    """Return the sha256 hex digest of a file's contents."""
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def stage_key(stage: str, *inputs: str, **params) -> str:
+    """Key a stage on the keys/hashes of its inputs and on its parameters."""
+    description = {"stage": stage, "inputs": inputs, "params": params}
+    return hashlib.sha256(
+        json.dumps(description, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class StageCache:
+    """Cache of stage outputs, one directory per stage key.
+
+    With ``evict_on_store`` (the default), the cache is trimmed to
+    ``max_size_gb`` after each new entry. Set it to False when several
+    processes share the cache, so that one of them doesn't evict the entries
+    another is using, and call ``evict`` once they are all done.
+
+    Writes queued on ``writer`` may still be copying out of an entry, so the
+    writer is flushed before anything is evicted.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        max_size_gb: float,
+        evict_on_store: bool = True,
+        writer: "BackgroundWriter | None" = None,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size_gb = max_size_gb
+        self.evict_on_store = evict_on_store
+        self.writer = writer
+
+    def cached(self, key: str, compute) -> Path:
+        """Return the entry for key, running compute(entry_dir) on a miss."""
+        entry = self.cache_dir / key
+        if entry.exists():
+            os.utime(entry)  # mark as recently used
+            logger.debug(f"Reusing cached outputs of stage {key[:12]}.")
+            return entry
+        tmp_entry = entry.with_suffix(".tmp")
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        tmp_entry.mkdir()
+        compute(tmp_entry)
+        tmp_entry.rename(entry)
+        if self.evict_on_store:
+            self.evict(keep=entry)
+        return entry
+
+    def evict(self, keep: Path | None = None):
+        """Delete least recently used entries until the cache fits its budget.
+
+        The ``keep`` entry (e.g. the one just stored) is never evicted.
+        """
+        if self.writer is not None:
+            self.writer.flush()
+        entries = sorted(
+            (
+                e
+                for e in self.cache_dir.iterdir()
+                if e != keep and e.suffix != ".tmp"
+            ),
+            key=lambda e: e.stat().st_mtime,
+        )
+        sizes = {
+            e: sum(f.stat().st_size for f in e.iterdir()) for e in entries
+        }
+        total = sum(sizes.values())
+        if keep is not None:
+            total += sum(f.stat().st_size for f in keep.iterdir())
+        for entry in entries:
+            if total <= self.max_size_gb * 1e9:
+                break
+            shutil.rmtree(entry)
+            total -= sizes[entry]
+            logger.debug(f"Evicted stage cache entry {entry.name[:12]}.")
+
+
+# %%
+# Background writer
+# -----------------
+# Intermediate images are written on a background thread, so that the next
+# compute stage doesn't wait for gzip compression.
+
+
+class BackgroundWriter:
+    """Run file writes on a background thread, in submission order.
+
+    At most ``max_pending`` writes are queued; ``submit`` blocks while the
+    queue is full, so a slow disk holds back compute instead of letting
+    images pile up in memory. ``flush`` waits for all queued writes; it and
+    ``submit`` re-raise the first error from any earlier write.
+
+    ``close`` (or leaving a ``with BackgroundWriter() as writer:`` block)
+    waits for the queued writes and stops the thread. Close a writer before
+    forking: its thread doesn't survive in the child processes.
+    """
+
+    # writers whose thread is still running, see ``any_running``
+    _running: set["BackgroundWriter"] = set()
+    _stop = object()  # queued by ``close`` to end the thread
+
+    def __init__(self, max_pending: int = 4):
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._errors: list[Exception] = []
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        BackgroundWriter._running.add(self)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._stop:
+                self._queue.task_done()
+                BackgroundWriter._running.discard(self)
+                return
+            write, args, kwargs = item
+            try:
+                write(*args, **kwargs)
+            except Exception as e:
+                self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._errors:
+            raise self._errors.pop(0)
+
+    def submit(self, write, *args, **kwargs):
+        """Queue ``write(*args, **kwargs)``, blocking while the queue is full.
+
+        The arguments must not be modified after they are submitted.
+        """
+        self._raise_error()
+        if not self._thread.is_alive():
+            raise RuntimeError("Cannot submit writes to a closed writer.")
+        self._queue.put((write, args, kwargs))
+
+    def flush(self):
+        """Wait until all submitted writes are done."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Wait until all submitted writes are done and stop the thread."""
+        if self._thread.is_alive():
+            self._queue.put(self._stop)
+            self._thread.join()
+        self._raise_error()
+
+    @classmethod
+    def any_running(cls) -> bool:
+        """Whether any writer in this process has not been closed yet."""
+        return bool(cls._running)
+
+    def __enter__(self) -> "BackgroundWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            self.close()
+        except Exception:
+            # don't mask the error that ended the block
+            if exc_type is None:
+                raise
+
+
+# %%
+# QC plots
+# --------
+# QC overlay plots are not rendered while subjects are processed. Instead,
+# downsampled previews of the plotted images are saved together with the
+# plot arguments, and all plots are rendered in parallel later.
+
+
+class QCPlots:
+    """Record QC overlay plots in ``qc_dir`` and render them later.
+
+    The images are downsampled by ``preview_factor`` before they are saved,
+    which keeps both the recording and the rendering cheap. Plots recorded
+    by a previous run are cleared.
+    """
+
+    def __init__(self, qc_dir: Path, preview_factor: int = 2):
+        self.qc_dir = Path(qc_dir)
+        self.preview_factor = preview_factor
+        shutil.rmtree(self.qc_dir, ignore_errors=True)
+        self.qc_dir.mkdir(parents=True)
+
+    def preview(
+        self, image: ants.ANTsImage, label: bool = False
+    ) -> ants.ANTsImage:
+        """Downsample an image for plotting.
+
+        Masks and label images (``label=True``) are resampled with nearest
+        neighbour interpolation, so that their values stay labels; the
+        pixel type doesn't tell them apart, as they are often read as float.
+        """
+        spacing = [s * self.preview_factor for s in image.spacing]
+        interp_type = 1 if label else 0
+        return ants.resample_image(image, spacing, interp_type=interp_type)
+
+    def record(
+        self,
+        image: ants.ANTsImage,
+        overlay: ants.ANTsImage,
+        filename: str,
+        label_overlay: bool = True,
+        **kwargs,
+    ):
+        """Save previews and ``ants.plot`` arguments of an overlay plot.
+
+        The overlay is taken to be a mask or label image, unless
+        ``label_overlay`` is False (e.g. for an intensity image overlay).
+        """
+        name = Path(filename).stem
+        for role, img, label in [
+            ("image", image, False),
+            ("overlay", overlay, label_overlay),
+        ]:
+            preview_path = self.qc_dir / f"{name}_{role}.nii"
+            ants.image_write(self.preview(img, label), preview_path.as_posix())
+        spec = {"filename": str(filename), "kwargs": kwargs}
+        (self.qc_dir / f"{name}.json").write_text(json.dumps(spec))
+
+    def render(self, spec_path: Path):
+        """Render a recorded overlay plot from its previews."""
+        spec = json.loads(spec_path.read_text())
+        image, overlay = (
+            ants.image_read(
+                (self.qc_dir / f"{spec_path.stem}_{role}.nii").as_posix()
+            )
+            for role in ["image", "overlay"]
+        )
+        ants.plot(image, overlay, filename=spec["filename"], **spec["kwargs"])
+
+    def render_all(self, n_workers: int):
+        """Render all recorded plots in parallel, in forked processes."""
+        if BackgroundWriter.any_running():
+            raise RuntimeError(
+                "Close all background writers before rendering QC plots, "
+                "their threads don't survive forking."
+            )
+        fork = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(n_workers, mp_context=fork) as executor:
+            list(
+                executor.map(self.render, sorted(self.qc_dir.glob("*.json")))
+            )
+        logger.info(f"Rendered QC plots recorded in {self.qc_dir}.")
+
+
+# %%
+# Setup
+# -----
+
+
+def prep_setup(
+    deriv_dir: Path,
+    script_name: str,
+    cache_size_gb: float | None = None,
+    evict_on_store: bool = True,
+    background_writer: bool = True,
+    max_pending: int = 4,
+    preview_factor: int = 2,
+) -> tuple[StageCache | None, BackgroundWriter | None, QCPlots]:
+    """Set up the stage cache, background writer and QC plots of a script.
+
+    - The stage cache (only with ``cache_size_gb``) lives in
+      ``deriv_dir/.stage_cache``, and its least recently used entries are
+      evicted once it grows beyond ``cache_size_gb`` (see ``StageCache``).
+    - The background writer writes intermediate images on a thread, so that
+      the next compute stage doesn't wait for gzip compression. At most
+      ``max_pending`` writes wait in its queue (see ``BackgroundWriter``).
+      Scripts that process subjects in forked workers give each its own
+      writer instead (``background_writer=False``).
+    - QC overlay plots are recorded in ``deriv_dir/.qc/script_name`` as
+      previews downsampled by ``preview_factor``, and rendered later with
+      ``QCPlots.render_all``.
+
+    Returns ``(stage_cache, writer, qc_plots)``, with None for the parts
+    that weren't asked for.
+    """
+    writer = BackgroundWriter(max_pending) if background_writer else None
+    stage_cache = None
+    if cache_size_gb is not None:
+        stage_cache = StageCache(
+            deriv_dir / ".stage_cache",
+            max_size_gb=cache_size_gb,
+            evict_on_store=evict_on_store,
+            writer=writer,
+        )
+    qc_plots = QCPlots(deriv_dir / ".qc" / script_name, preview_factor)
+    return stage_cache, writer, qc_plots
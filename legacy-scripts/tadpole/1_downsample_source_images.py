@@ -1,9 +1,20 @@
 import argparse
+import sys
 from pathlib import Path
 
+from brainglobe_utils.IO.image import save_any
+from brainglobe_utils.IO.image.load import read_with_dask
 from loguru import logger
 
-from brainglobe_template_builder.preproc.transform_utils import downsample
+# the shared helpers live in the atlas_forge package at the root of the repo
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from atlas_forge.multiscale import (  # noqa: E402
+    build_pyramid,
+    downsample_lazily,
+    pyramid_resolutions,
+    save_ome_zarr,
+)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Downsample source images")
@@ -27,6 +38,14 @@ if __name__ == "__main__":
         help="Target isotropic resolution",
         required=True,
     )
+    parser.add_argument(
+        "--output_format",
+        choices=["tif", "ome-zarr"],
+        default="tif",
+        help="Save a tif at the target resolution, or a multiscale OME-Zarr "
+        "starting at the target resolution, with a level per halving of the "
+        "resolution until the smallest axis is under 64 voxels",
+    )
 
     args = parser.parse_args()
 
@@ -52,9 +71,20 @@ if __name__ == "__main__":
             f"sub-{sample_id}_res-{target_isotropic_resolution}"
             f"um_channel-{channel}.tif"
         )
-        downsample(
-            sample_folder,
-            template_raw_data / sample_filename,
+        # both formats are downsampled the same way, reading one plane at a
+        # time, and only the (much smaller) result is held in memory
+        downsampled = downsample_lazily(
+            read_with_dask(str(sample_folder)),
             [1 / axial_factor, 1 / in_plane_factor, 1 / in_plane_factor],
-        )
+        ).compute()
+        if args.output_format == "ome-zarr":
+            resolutions = pyramid_resolutions(
+                downsampled.shape, target_isotropic_resolution
+            )
+            save_ome_zarr(
+                build_pyramid(downsampled, resolutions),
+                (template_raw_data / sample_filename).with_suffix(".ome.zarr"),
+            )
+        else:
+            save_any(downsampled, template_raw_data / sample_filename)
         logger.info(f"{sample_filename} downsampled.")
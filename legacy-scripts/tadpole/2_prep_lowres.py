@@ -14,12 +14,16 @@ This script will:
 - Split the image and mask into hemispheres and reflect each hemisphere
 - Generate symmetric brains using either the left or right hemisphere
 - Save all resulting images as nifti files to be used for template construction
+
+N4 correction results are cached per subject, so re-running the script only
+recomputes what changed (e.g. a new subject).
 """
 
 # %%
 # Imports
 # -------
 import os
+import sys
 from datetime import date
 from pathlib import Path
 
@@ -32,9 +36,14 @@ from tqdm import tqdm
 from brainglobe_template_builder.io import (
     file_path_with_suffix,
 )
-from brainglobe_template_builder.preproc.splitting import (
-    generate_arrays_4template,
-    save_array_dict_to_nii,
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from prep_utils import (  # noqa: E402
+    hash_file,
+    iter_template_arrays,
+    prep_setup,
+    save_template_arrays,
+    stage_key,
 )
 
 # %%
@@ -71,6 +80,26 @@ today = date.today()
 current_script_name = os.path.basename(__file__).replace(".py", "")
 logger.add(project_dir / "logs" / f"{today}_{current_script_name}.log")
 
+# %%
+# Set up caching, background writes and QC plotting
+# -------------------------------------------------
+# The outputs of the N4 correction stage are kept in a content-addressed cache,
+# keyed on the hash of the stage inputs and the stage parameters, and limited
+# to 20 GB. Intermediate images are written on a
+# background thread, which is flushed before any cache entry is evicted.
+# QC overlay plots are not rendered while subjects are processed. Instead,
+# downsampled previews of the plotted images are saved together with the
+# plot arguments, and all plots are rendered in parallel at the end of the
+# script (or later, by running the "Render QC plots" cell on its own).
+# Set render_qc to False to skip rendering, e.g. on batch runs.
+
+stage_cache, writer, qc_plots = prep_setup(
+    deriv_dir, current_script_name, cache_size_gb=20
+)
+render_qc = True
+n_qc_workers = 4
+
+
 # %%
 # Load a dataframe with image paths to use for the template
 # ---------------------------------------------------------
@@ -143,11 +172,19 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
     )
 
     # Bias field correction (to homogenise intensities)
-    image_n4 = ants.n4_bias_field_correction(image_ants)
+    n4_key = stage_key("n4", hash_file(nii_path))
+    n4_entry = stage_cache.cached(
+        n4_key,
+        lambda entry: ants.image_write(
+            ants.n4_bias_field_correction(image_ants),
+            (entry / "image_n4.nii.gz").as_posix(),
+        ),
+    )
+    image_n4 = ants.image_read((n4_entry / "image_n4.nii.gz").as_posix())
     image_n4_masked_numpy = image_n4.numpy() * mask.numpy()
     image_n4_path = file_path_with_suffix(nii_path, "_N4")
     image_n4 = image_n4.new_image_like(image_n4_masked_numpy)
-    ants.image_write(image_n4, image_n4_path.as_posix())
+    writer.submit(ants.image_write, image_n4, image_n4_path.as_posix())
     logger.debug(
         f"Created N4 bias field corrected image as {image_n4_path.name}."
     )
@@ -156,7 +193,7 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
     mask_plot_path = (
         deriv_subj_dir / f"{file_prefix}_orig-asr_N4_mask-overlay.png"
     )
-    ants.plot(
+    qc_plots.record(
         image_n4,
         mask,
         overlay_alpha=0.5,
@@ -164,11 +201,11 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
         title="Brain mask over image",
         filename=mask_plot_path.as_posix(),
     )
-    logger.debug("Plotted overlay to visually check mask.")
+    logger.debug("Recorded overlay to visually check mask.")
 
     # Plot the halves mask over the aligned image to check the split
     output_prefix = file_path_with_suffix(nii_path, "_N4_aligned_", new_ext="")
-    ants.plot(
+    qc_plots.record(
         image_n4,
         halves_mask,
         overlay_alpha=0.5,
@@ -176,7 +213,7 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
         title="Aligned image split into right and left halves",
         filename=output_prefix.as_posix() + "halves-overlay.png",
     )
-    logger.debug("Plotted overlays to visually check alignment.")
+    logger.debug("Recorded overlays to visually check alignment.")
 
     # Generate arrays for template construction and save as niftis
     use4template_dir = Path(output_prefix.as_posix() + "padded_use4template")
@@ -187,10 +224,12 @@ for idx, row in tqdm(df.iterrows(), total=n_subjects):
             file.unlink()
     use4template_dir.mkdir(exist_ok=True)
 
-    array_dict = generate_arrays_4template(
+    template_arrays = iter_template_arrays(
         subject, image_n4.numpy(), mask.numpy(), pad=2
     )
-    save_array_dict_to_nii(array_dict, use4template_dir, vox_sizes)
+    writer.submit(
+        save_template_arrays, template_arrays, use4template_dir, vox_sizes
+    )
     use4template_dirs[subject] = use4template_dir
     logger.info(
         f"Saved images for template construction in {use4template_dir}."
@@ -258,6 +297,10 @@ for _, row in df.iterrows():
 # %%
 # Save the file paths to text files, each in a separate directory
 
+# Make sure all images are on disk before they are listed, and stop the
+# writer thread before QC plots are rendered in forked processes
+writer.close()
+
 for key, paths in filepath_lists.items():
     kind, label = key.split("-")  # e.g. "asym" and "brain"
     n_images = len(paths)
@@ -265,3 +308,12 @@ for key, paths in filepath_lists.items():
     template_dir = project_dir / "templates" / template_name
     template_dir.mkdir(exist_ok=True)
     np.savetxt(template_dir / f"{label}_paths.txt", paths, fmt="%s")
+
+# %%
+# Render QC plots
+# ---------------
+# Render all recorded QC plots in parallel. Run this cell on its own to
+# render them later, if render_qc was False.
+
+if render_qc:
+    qc_plots.render_all(n_qc_workers)
@@ -5,64 +5,71 @@ from brainglobe_utils.IO.image import load_any
 from brainglobe_space import AnatomicalSpace
 from pathlib import Path
 import numpy as np
+import sys
+
+# the shared helpers live in the atlas_forge package at the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from atlas_forge.figures import cached_figure, figure_key  # noqa: E402
+
+output_dir = Path.home()/"molerat/"
+# plot every n-th voxel along each axis; 1 plots at full resolution. A strided
+# preview (e.g. 4) is enough to compare slices by eye and a lot faster for the
+# attenuated MIPs, but it is opt-in so the figures match the volumes by default
+preview_factor = 1
+# figures are cached per (volume, slices, plot parameters), so re-running with
+# the same choices just copies the cached figure (png and pdf)
+cache_dir = output_dir/".plot_cache"
+
+
+def plot_slices(image, show_slices, name, mip_attenuation, vmin=2000, vmax=45000):
+    """Plot show_slices of image (and its MIPs) with crosshairs, on a strided preview if preview_factor > 1."""
+    key = figure_key(image, show_slices, preview_factor, mip_attenuation, vmin, vmax)
+
+    def plot_to_cache(cache_dir, key):
+        figure = plot_figure(image, show_slices, mip_attenuation, vmin, vmax)
+        _save_and_close_figure(figure, cache_dir, key)
+
+    if cached_figure(key, cache_dir, output_dir, name, plot_to_cache):
+        print(f"Using cached figure for {name}")
+
+
+def plot_figure(image, show_slices, mip_attenuation, vmin, vmax):
+    """Plot the figure of plot_slices."""
+    preview = image[::preview_factor, ::preview_factor, ::preview_factor]
+    preview_slices = tuple(s // preview_factor for s in show_slices)
+    figure, axes = plot_orthographic(
+        preview,
+        show_slices=preview_slices,
+        vmin=vmin,
+        vmax=vmax,
+        # fewer voxels along each ray, so attenuate more per voxel to keep the same look
+        mip_attenuation=mip_attenuation*preview_factor
+    )
+    space = AnatomicalSpace("ASR", shape=preview.shape)
+    slice_shift_due_to_padding = [(np.max(preview.shape)-preview.shape[i])//2 for i in range(3)]
+    for i in range(3):
+        ax = axes[i]
+        h, v = space.index_pairs[i]
+        ax.axhline(preview_slices[h]+slice_shift_due_to_padding[h], color="r", linestyle="--", alpha=0.5)
+        ax.axvline(preview_slices[v]+slice_shift_due_to_padding[v], color="r", linestyle="--", alpha=0.5)
+    return figure
+
 
 if __name__ == "__main__":
     template_image = BrainGlobeAtlas("african_molerat_20um").reference
     individual_image = load_any(Path.home()/"molerat/sub-d09_hemi-R_res-20um_orig-asr.nii.gz")
-    
+
     range_1_99 = _auto_adjust_contrast(individual_image)
     vmin = range_1_99["vmin"]
     vmax = range_1_99["vmax"]
-    
+
     #rescale template to range of individual
     template_image = template_image.astype(np.float64)
     template_image = ((template_image-np.min(template_image))/np.max(template_image)*(vmax-vmin))+vmin
-    target_size = tuple([max(template_image.shape[i], individual_image.shape[i]) for i in range(3)])
 
-    space = AnatomicalSpace("ASR", shape=template_image.shape)
     #  select nice slices to show
     show_slices_template = (322, 131, 173)
-    slice_shift_due_to_padding_template = [(np.max(template_image.shape)-template_image.shape[i])//2 for i in range(3)]
-    print(slice_shift_due_to_padding_template)
-    
-    figure, axes = plot_orthographic(
-        template_image,
-        show_slices=show_slices_template,
-        vmin=2000,
-        vmax=45000,
-        mip_attenuation=0.004
-    )
-    for i in range(3):
-        ax = axes[i]
-        h, v = space.index_pairs[i]
-        print(h,v)
-        ax.axhline(show_slices_template[h]+slice_shift_due_to_padding_template[h], color="r", linestyle="--", alpha=0.5)
-        ax.axvline(show_slices_template[v]+slice_shift_due_to_padding_template[v], color="r", linestyle="--", alpha=0.5)
-    
-    _save_and_close_figure(
-        figure,
-        Path.home()/"molerat/",
-        "template"
-    )
-    
-    slice_shift_due_to_padding = [(np.max(individual_image.shape)-individual_image.shape[i])//2 for i in range(3)]
+    plot_slices(template_image, show_slices_template, "template", mip_attenuation=0.004)
+
     show_slices_individual = (371, 183, 174)
-    figure, axes = plot_orthographic(
-        individual_image, 
-        show_slices=show_slices_individual,
-        vmin=2000,
-        vmax=45000,
-        mip_attenuation=0.002
-    )
-    for i in range(3):
-        ax = axes[i]
-        h, v = space.index_pairs[i]
-        ax.axhline(show_slices_individual[h]+slice_shift_due_to_padding[h], color="r", linestyle="--", alpha=0.5)
-        ax.axvline(show_slices_individual[v]+slice_shift_due_to_padding[v], color="r", linestyle="--", alpha=0.5)
-    
-    _save_and_close_figure(
-        figure,
-        Path.home()/"molerat/",
-        "sub-d09_hemi-R"
-    )
-    
+    plot_slices(individual_image, show_slices_individual, "sub-d09_hemi-R", mip_attenuation=0.002)
@@ -1,7 +1,10 @@
-
-from brainglobe_template_builder.preprocess import preprocess
-from brainglobe_template_builder.utils.preproc_config import PreprocConfig, MaskConfig
 from pathlib import Path
+import sys
+
+# the shared helpers live in the atlas_forge package at the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from atlas_forge.incremental import incremental_preprocess, read_mask_overrides  # noqa: E402
+
 
 if __name__ == "__main__":
     output_dir = Path("/media/ceph/neuroinformatics/neuroinformatics/atlas-forge/ZebraFinch/")
@@ -10,5 +13,12 @@ if __name__ == "__main__":
     # because it gave fewer over-generous masks (otherwise also 0065 and 8913 over-generous)
     # excluded 8761m as worst male image, to create balanced sex template (ten each)
     # initial template will be a manually aligned 8222f sample, with 60 extra pixels padding on top of the default 30.
-    config = PreprocConfig(output_dir=output_dir, mask=MaskConfig(), pad_pixels=30)
-    preprocess(output_dir/"standardised/standardised_images.csv", config=config)
\ No newline at end of file
+    # the subjects the default MaskConfig doesn't work for can get their own parameters in mask_overrides.csv (one
+    # row per subject, one column per MaskConfig field, empty cells keep the default), so they can be fixed without
+    # re-running the whole cohort. It has no rows yet: add them once parameters are checked on the preprocessed-QC
+    # grids, only the subjects whose row changed are preprocessed again
+    mask_overrides = read_mask_overrides(Path(__file__).parent/"mask_overrides.csv")
+    standardised_csv = output_dir/"standardised/standardised_images.csv"
+    # only subjects that are new, or whose standardised image or mask parameters changed, are preprocessed again;
+    # per-stage wall/CPU time, peak memory and I/O are profiled, to find what blows the SLURM time limit
+    incremental_preprocess(standardised_csv, output_dir, mask_overrides, pad_pixels=30, workers=8)
@@ -1,8 +1,18 @@
-from brainglobe_template_builder.standardise import standardise
-
 from pathlib import Path
+import sys
+
+# the shared helpers live in the atlas_forge package at the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from atlas_forge.incremental import incremental_standardise  # noqa: E402
+
+
 if __name__ == "__main__":
     source_csv = Path("/media/ceph/margrie/sweiler/RawData/Tracing_Imaging/serial2p/Bird_brains/zebra_finch_atlas/2026-05-26_zebrafinch.csv")
     output_dir = Path("/media/ceph/neuroinformatics/neuroinformatics/atlas-forge/ZebraFinch/")
     output_vox_size = 25
-    standardise(source_csv=source_csv, output_dir=output_dir, output_vox_size=output_vox_size)
+    # subjects are standardised in parallel, as long as their expected memory (their peak on the last run, or an
+    # estimate on the first) fits in the budget; the cores are split between the workers
+    workers = 8
+    memory_budget_gb = 48
+    # only re-standardises rows whose inputs changed since the last run, and removes the outputs of dropped rows
+    incremental_standardise(source_csv, output_dir, output_vox_size, workers=workers, memory_budget_gb=memory_budget_gb)